@@ -1,6 +1,6 @@
 #!/usr/bin/env python
 
-import argparse, random, os, glob
+import argparse, random, os, glob, hashlib, shutil
 import fastatools as ft        #Available at https://github.com/jtladner/Modules
 import kmertools as kt        #Available at https://github.com/jtladner/Modules
 
@@ -16,6 +16,7 @@ def main():
     parser.add_argument("-t", "--target", default=1, type=float, help="Target threshold for xmer coverage. Algorithm will continue until at least the max proportion of total Xmers are in the design.")
     parser.add_argument("-e", "--exclude", default="X-", help="Any Xmers or yMers containing these chaarcters will be excluded. By default this will be done for both the SW and SC portions of the design. However, the behavior for C residues will be different in the SW portion, when used in combination with '--swCtoS'.")
     parser.add_argument("--swCtoS", default=False, action="store_true", help="If this flag is provided, Cysteine residues will be converted to Serine residues in the SW portion of the design")
+    parser.add_argument("--skipUnchanged", default=False, action="store_true", help="If this flag is provided, input files whose contents and design parameters match the fingerprint recorded by a previous run will not be redesigned. The previously generated outputs will be reused. Fingerprints are only computed and recorded when this flag is provided.")
 
     reqArgs = parser.add_argument_group('required arguments')
     reqArgs.add_argument("-x", "--xMerSize", type=int, help="Size of Xmers, which represent potential linear epitopes contained within peptides/Ymers.", required=True)
@@ -39,22 +40,48 @@ def main():
         inputStrMatches = glob.glob(args.inputStr)
         targetFastaL += inputStrMatches
     
+    # Open concatenated output file. Peptides from each input file are appended as soon as its design is finished
+    combined = open("SWSC-x%d-y%d-t%.3f.fasta" % (args.xMerSize, args.yMerSize, args.target), "w")
+    
     #Run set cover analyses
     for each in targetFastaL:   #Step through each input file
+        #Reuse the previous design, if nothing has changed since it was generated
+        numPeps = None
+        if args.skipUnchanged:
+            fp = fingerprint(each, args)
+            numPeps = unchanged(each, fp, args)
+            if numPeps is not None:
+                print("%s is unchanged since the last run. Skipping design." % (each))
+                if numPeps > 0:
+                    with open(outName(each, args), "r") as fin:
+                        shutil.copyfileobj(fin, combined)
+        
         #Run the design
-        numPeps = design(each, args)
+        if numPeps is None:
+            if not args.skipUnchanged and os.path.isfile(fingerprintName(each, args)):
+                os.remove(fingerprintName(each, args))     #The outputs are about to be overwritten, so an old fingerprint no longer stands for them
+            numPeps = design(each, args, combined)
+            if args.skipUnchanged:
+                writeFingerprint(each, fp, numPeps, args)
 
         if args.summary:
             fout.write("%s\t%.3f\t%d\n" % (each, args.target, numPeps))
-                
-    # Generate concatenated output files
-    ft.combine_fastafiles(glob.glob("*_SWSC-x%d-y%d-t%.3f.fasta" % (args.xMerSize, args.yMerSize, args.target)), "SWSC-x%d-y%d-t%.3f.fasta" % (args.xMerSize, args.yMerSize, args.target))
-        
+    
+    combined.close()
+    if args.summary:
+        fout.close()
+
 
 
 #----------------------End of main()
 
-def design(inp, args):
+def outName(inp, args):
+    return "%s_SWSC-x%d-y%d-t%.3f.fasta" % (os.path.basename(inp), args.xMerSize, args.yMerSize, args.target)
+
+def manifestName(inp, args):
+    return "%s_SWSC-x%d-y%d-manifest.tsv" % (os.path.basename(inp), args.xMerSize, args.yMerSize)
+
+def design(inp, args, combined=None):
 
     # Dictionary that will be used to keep track of the number of peptides in each design
     numPepD = {}
@@ -76,7 +103,7 @@ def design(inp, args):
         return 0
     
     # Open output file for tracking the proportion covered Xmers after adding each peptide
-    with open("%s_SWSC-x%d-y%d-manifest.tsv" % (os.path.basename(inp), args.xMerSize, args.yMerSize), "w") as foutTrack:
+    with open(manifestName(inp, args), "w") as foutTrack:
         foutTrack.write("Peptide\tXmerPropPriorToAdding\n")
         
         # Read in all target Xmers
@@ -167,12 +194,16 @@ def design(inp, args):
         numPep = len(repSeqs+newSeqs)
         if numPep > 0:
             rmvMani = 0
-            ft.write_fasta(repNames+newNames, repSeqs+newSeqs, "%s_SWSC-x%d-y%d-t%.3f.fasta" % (os.path.basename(inp), args.xMerSize, args.yMerSize, args.target))
+            ft.write_fasta(repNames+newNames, repSeqs+newSeqs, outName(inp, args))
+            # Append the same peptides to the concatenated output, if one is open
+            if combined:
+                for pn, ps in zip(repNames+newNames, repSeqs+newSeqs):
+                    combined.write(">%s\n%s\n" % (pn, ps))
         else:
             rmvMani = 1
     
     if rmvMani:
-        os.remove("%s_SWSC-x%d-y%d-manifest.tsv" % (os.path.basename(inp), args.xMerSize, args.yMerSize))
+        os.remove(manifestName(inp, args))
     
     return numPep
 
@@ -262,6 +293,43 @@ def choosePep(ysD, xcD, args):
     
     return thisChoice
 
+def fingerprint(inp, args):
+    # Hash the input file contents along with every parameter that affects the design
+    h = hashlib.sha256()
+    with open(inp, "rb") as fin:
+        for block in iter(lambda: fin.read(1<<20), b""):
+            h.update(block)
+    params = "x=%d\ty=%d\ts=%d\tt=%.3f\te=%s\tswCtoS=%s" % (args.xMerSize, args.yMerSize, args.step_size, args.target, "".join(sorted(args.exSet)), args.swCtoS)
+    h.update(params.encode())
+    return h.hexdigest()
+
+def fingerprintName(inp, args):
+    return "%s_SWSC-x%d-y%d-t%.3f.fingerprint" % (os.path.basename(inp), args.xMerSize, args.yMerSize, args.target)
+
+def writeFingerprint(inp, fp, numPeps, args):
+    # Written only after the design outputs are complete, so an interrupted run is never skipped
+    with open(fingerprintName(inp, args), "w") as fout:
+        fout.write("Fingerprint\tNumPeps\n")
+        fout.write("%s\t%d\n" % (fp, numPeps))
+
+def unchanged(inp, fp, args):
+    # Returns the number of peptides from the previous design if it can be reused, otherwise None
+    fpName = fingerprintName(inp, args)
+    if not os.path.isfile(fpName):
+        return None
+    with open(fpName, "r") as fin:
+        lines = fin.read().splitlines()
+    if len(lines) < 2:
+        return None
+    oldFp, numPeps = lines[1].split("\t")
+    numPeps = int(numPeps)
+    if oldFp != fp:
+        return None
+    # The outputs the fingerprint stands for must still exist
+    if numPeps > 0 and not (os.path.isfile(outName(inp, args)) and os.path.isfile(manifestName(inp, args))):
+        return None
+    return numPeps
+
 def writeXmerDict(xD, outname):
     with open(outname, "w") as fout:
         fout.write("Xmer\tCount\n")
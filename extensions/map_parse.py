@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import sys, re
+import functools
 
 import protein_oligo_library as oligo
 
@@ -85,7 +86,7 @@ def main():
 
     oligo.fill_tax_gaps( taxid_dict, gap_dict )
     
-    oligo_file = open( args.output + "_oligo.tsv", 'w+' )
+    oligo_file = open( args.output + "_oligo.tsv", 'w' )
     oligo_file.write( 
                       "Oligo Name\tNum Sequences Share 7-mer\tNum Species Share 7-mer\t"
                       "Num Genera Share 7-mer\t"
@@ -96,16 +97,26 @@ def main():
                     )
 
     missing_ids = set()
-    oligo_file.close()
+    JOIN_CHAR = '~'
+
+    # Species- genus- and family-centric counts, updated as each oligo is written
+    famDict = {}
+    genDict = {}
+    spDict = {}
+    
+    famDictSpec = {}
+    genDictSpec = {}
+    spDictSpec = {}
+
     for line in open( args.map, 'r' ):
 
-        oligo_file = open( args.output + "_oligo.tsv", 'a' )
         line = line.strip("\n").split( '\t' )
+        ref_names = line[ 1 ].split( JOIN_CHAR )
 
         if args.code:
-            taxids = set( [ get_OXXids_from_name( decode[item] ) for item in line[ 1 ].split( '~' ) ] )
+            taxids = set( [ get_OXXids_from_name( decode[item] ) for item in ref_names ] )
         else:
-            taxids = set( [ get_OXXids_from_name( item ) for item in line[ 1 ].split( '~' ) ] )
+            taxids = set( [ get_OXXids_from_name( item ) for item in ref_names ] )
         
 #        taxids = oligo.create_valid_taxids( taxids, missing_id_key )
 
@@ -115,9 +126,7 @@ def main():
         current_genus = set([x[1] for x in taxids if x[1]])
         current_family = set([x[2] for x in taxids if x[2]])
 
-        JOIN_CHAR = '~'
-
-        current_entry += "%d\t%d\t%d\t%d\t" % ( len( line[ 1 ].split( '~' ) ), len( current_species ),
+        current_entry += "%d\t%d\t%d\t%d\t" % ( len( ref_names ), len( current_species ),
                                             len( current_genus ),
                                             len( current_family )
                                           )
@@ -128,46 +137,16 @@ def main():
 
         oligo_file.write( current_entry )
 
-        oligo_file.close()
+        #species-centric
+        count_names( current_species, spDict, spDictSpec )
+        #genus-centric
+        count_names( current_genus, genDict, genDictSpec )
+        #family-centric
+        count_names( current_family, famDict, famDictSpec )
 
-    print( "Missing ids: %s" % ",".join( missing_ids ) )
-    # Generate species- genus- and family-centric files
-    
-    famDict = {}
-    genDict = {}
-    spDict = {}
-    
-    famDictSpec = {}
-    genDictSpec = {}
-    spDictSpec = {}
-    
-    fin = open( args.output + "_oligo.tsv", 'r' )
+    oligo_file.close()
 
-    linecount=0
-    for line in fin:
-        linecount+=1
-        if linecount==1:
-            headers = line.strip("\n").split("\t")
-        else:
-            name, numSeqs, numSp, numGen, numFam, namesSp, namesGen, namesFam = line.strip("\n").split("\t")
-            #species-centric
-            for each in namesSp.strip(',').split(JOIN_CHAR):
-                if len( each ) > 0:
-                    spDict[each] = spDict.get(each, 0) + 1
-                    if len(namesSp.strip(',').split(JOIN_CHAR))==1:
-                        spDictSpec[each] = spDictSpec.get(each, 0) + 1
-            #genus-centric
-            for each in namesGen.strip(',').split(JOIN_CHAR):
-                if len( each ) > 0:
-                    genDict[each] = genDict.get(each, 0) + 1
-                    if len(namesGen.strip(',').split(JOIN_CHAR))==1:
-                        genDictSpec[each] = genDictSpec.get(each, 0) + 1
-            #family-centric
-            for each in namesFam.strip(',').split(JOIN_CHAR):
-                if len( each ) > 0:
-                    famDict[each] = famDict.get(each, 0) + 1
-                    if len(namesFam.strip(',').split(JOIN_CHAR))==1:
-                        famDictSpec[each] = famDictSpec.get(each, 0) + 1
+    print( "Missing ids: %s" % ",".join( missing_ids ) )
     
     print (len(spDict), len(spDictSpec))
     print (len(genDict), len(genDictSpec))
@@ -200,9 +179,22 @@ def main():
         fout.write("%s\t%d\t%d\n" % (fam, count, specific))
     fout.close()
 
+def count_names( names, total_dict, specific_dict ):
+    """
+       Adds one oligo covering each of names to total_dict, and to
+       specific_dict as well if names holds only a single name
+    """
+    for each in names:
+        total_dict[each] = total_dict.get(each, 0) + 1
+        if len( names ) == 1:
+            specific_dict[each] = specific_dict.get(each, 0) + 1
+
+OXX_PATTERN = re.compile( r"OXX=(\d*),(\d*),(\d*),(\d*)" )
+
+# The same reference names recur on many lines of a map, so each is only parsed once
+@functools.lru_cache( maxsize = None )
 def get_OXXids_from_name(name):
-    oxpat = re.compile("OXX=(\d*),(\d*),(\d*),(\d*)")
-    tax_ids = oxpat.search(name)
+    tax_ids = OXX_PATTERN.search(name)
     return tax_ids.group(2),tax_ids.group(3),tax_ids.group(4)
 
 if __name__ == '__main__':
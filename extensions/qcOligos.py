@@ -2,15 +2,16 @@
 
 import inout as io         # Available here: https://github.com/jtladner/Modules
 import fastatools as ft    # Available here: https://github.com/jtladner/Modules
-import glob, optparse
+import glob, optparse, os, pickle, tempfile, zlib
+import multiprocessing as mp
+import numpy as np
 from collections import defaultdict
 
+# Only needed to translate encodings with characters other than A, C, G and T
 try:
     from Bio.Seq import Seq
-    testTranslation = True
 except:
-    testTranslation = False
-    print("***Not testing translations because couldn't import biopython\n")
+    Seq = None
 
 try:
     import matplotlib.pyplot as plt
@@ -37,191 +38,664 @@ def main():
     p.add_option('-l', '--logFile', default="qcOligos.log", help='Name for log file of results [qcOligos.log]')
     p.add_option('-o', '--figName', default="gcBoxPlot.png", help='Name for log file of results [gcBoxPlot.png]')
     p.add_option('-t', '--trimTo', default=40, type=int, help='With this option, you can specify a length to trim the nucleotide encodings to before checking for uniqueness, etc. This is useful, for example, if you will not be able to seequence through the full DNA tag variable region [40]')
+    p.add_option('-j', '--jobs', default=1, type=int, help='Number of processes to use. With more than one, each input is split into this many pieces that are checked in parallel, and the names and sequences needed for the uniqueness checks are divided among the processes through temporary files (in TMPDIR) [1]')
     
     opts, args = p.parse_args()
     
-    #Open log file
-    fout = open(opts.logFile, "w")
+    # Each input is read once, with every check that uses it registered on the engine.
+    # The log is written after all of the inputs have been read, in the order the checks were added to it
+    engine = QCEngine()
+    logL = []
     
     if opts.pepFasta:
-        fout.write("\n******Checking peptide fasta file.******\n")
-        checkFasta(opts.pepFasta, fout)
-        identNames(opts.pepFasta, fout)
+        logL.append("\n******Checking peptide fasta file.******\n")
+        logL.append(engine.register("pep", FastaSummary(opts.pepFasta)))
+        logL.append(engine.register("pep", IdenticalNames()))
         
-        if opts.nucFasta and testTranslation:
-            checkTranslation(opts.pepFasta, opts.nucFasta, fout)
+        if opts.nucFasta:
+            peptides = engine.register("pep", PeptideDict())
+            logL.append(engine.register("nuc", TranslationCheck(peptides)))
     
     if opts.nucFasta:
-        fout.write("\n\n******Checking encodings fasta file.******\n")
-        checkFasta(opts.nucFasta, fout)
-        identNames(opts.nucFasta, fout)
-        findIdentical(opts.nucFasta, fout)
+        logL.append("\n\n******Checking encodings fasta file.******\n")
+        logL.append(engine.register("nuc", FastaSummary(opts.nucFasta)))
+        logL.append(engine.register("nuc", IdenticalNames()))
+        logL.append(engine.register("nuc", IdenticalSeqs()))
 
         if opts.trimTo:
-            fout.write("\n\n******Checking encodings fasta file, trimmed to %d nucleotides.******\n" % (opts.trimTo))
-            checkFasta(opts.nucFasta, fout, trimTo=opts.trimTo)
-            findIdentical(opts.nucFasta, fout, trimTo=opts.trimTo)
+            logL.append("\n\n******Checking encodings fasta file, trimmed to %d nucleotides.******\n" % (opts.trimTo))
+            logL.append(engine.register("nuc", FastaSummary(opts.nucFasta, trimTo=opts.trimTo)))
+            logL.append(engine.register("nuc", IdenticalSeqs(trimTo=opts.trimTo)))
 
     if opts.nucFastaAdapt:
-        fout.write("\n\n******Checking encodings w/Adapters fasta file.******\n")
-        checkFasta(opts.nucFastaAdapt, fout)
-        checkAdapters(opts.nucFastaAdapt, fout)
-        identNames(opts.nucFastaAdapt, fout)
+        logL.append("\n\n******Checking encodings w/Adapters fasta file.******\n")
+        logL.append(engine.register("adapt", FastaSummary(opts.nucFastaAdapt)))
+        logL.append(engine.register("adapt", AdapterCheck()))
+        logL.append(engine.register("adapt", IdenticalNames()))
         
         if opts.nucFasta:
-            checkNucsMatch(opts.nucFasta, opts.nucFastaAdapt, fout)
+            nucsMatch = NucsMatchCheck()
+            engine.register("nuc", nucsMatch, "ntKey")
+            logL.append(engine.register("adapt", nucsMatch, "adKey"))
     
-
+    gcD = {}
     if makePlot:
-        
-        seqsD = {}
         if opts.nucFasta:
-            n, s = ft.read_fasta_lists(opts.nucFasta)
-            seqsD["Ecodings"] = s
+            gcD["Ecodings"] = engine.register("nuc", GCValues())
         if opts.nucFastaAdapt:
-            n,s = ft.read_fasta_lists(opts.nucFastaAdapt)
-            seqsD["wAdapters"] = s
+            gcD["wAdapters"] = engine.register("adapt", GCValues())
 
-        if len(seqsD)>0:
-            gcD = {k:[gc(x) for x in v] for k,v in seqsD.items()}
-        
-            fig,ax = plt.subplots(1,1,figsize=(8, 5),facecolor='w')
-    
-            ax.boxplot(list(gcD.values()))
-            ax.set_xticks(range(1, len(gcD)+1))
-            ax.set_xticklabels(gcD.keys())
-            ax.set_ylabel("Proportion GC", fontsize=25)
-            
-            #Save figure
-            fig.savefig(opts.figName,dpi=200,bbox_inches='tight')
+    inputL = [("pep", opts.pepFasta), ("nuc", opts.nucFasta), ("adapt", opts.nucFastaAdapt)]
+    if opts.jobs > 1:
+        with tempfile.TemporaryDirectory() as tmpDir:
+            engine.runSharded(inputL, opts.jobs, tmpDir)
+    else:
+        engine.run(inputL)
 
-    #Close log file
+    #Write log file
+    fout = open(opts.logFile, "w")
+    for each in logL:
+        if isinstance(each, str):
+            fout.write(each)
+        else:
+            each.report(fout)
     fout.close()
+
+    if len(gcD)>0:
+        
+        fig,ax = plt.subplots(1,1,figsize=(8, 5),facecolor='w')
+
+        ax.boxplot([v.values for v in gcD.values()])
+        ax.set_xticks(range(1, len(gcD)+1))
+        ax.set_xticklabels(gcD.keys())
+        ax.set_ylabel("Proportion GC", fontsize=25)
+        
+        #Save figure
+        fig.savefig(opts.figName,dpi=200,bbox_inches='tight')
     
 ###------------------------End of main()--------------------------------
 
-def checkNucsMatch(ntF, adF, fout):
-    ntD = ft.read_fasta_dict_upper(ntF)
-    adD = ft.read_fasta_dict_upper(adF)
+# Checks come in two kinds. Local checks have add(name, seq) and only need the records they are given,
+# so separate copies (from empty()) can check pieces of an input and be combined with merge().
+# Keyed checks need every record with the same key together. For each record, one of their methods returns a
+# (key, value) pair, which is passed to addKeyed() along with the record's position. summary() then gives a result
+# that can be combined with the results for other keys using mergeResults(), and is stored as the check's result
+
+class QCEngine:
+    # Reads each input fasta once, passing every record to all of the checks registered for that input
     
-    matchCount=0
-    for name, ntS in ntD.items():
-        if adD[name][19:-19] != ntS:
-            fout.write("%s does not match %s\n" % (ntS, adD[name][19:-19]))
+    def __init__(self):
+        self.local = defaultdict(list)
+        self.keyed = defaultdict(list)
+        self.keyedChecks = []
+
+    def register(self, role, check, feed=None):
+        # feed is the name of the method records are passed to, "add" for local checks and "key" for keyed checks
+        if check.keyed:
+            self.keyed[role].append((check, feed or "key"))
+            if not any(each is check for each in self.keyedChecks):
+                self.keyedChecks.append(check)
         else:
-            matchCount+=1
-    
-    if matchCount == len(ntD):
-        fout.write("All encodings with adapters (%d) match the encodings without adapters.\n\n" % (matchCount))
+            self.local[role].append((check, feed or "add"))
+        for part in getattr(check, "parts", []):
+            self.register(role, part)
+        return check
 
-def checkFasta(fasta, fout, trimTo=False):
-    names, seqs = ft.read_fasta_lists(fasta)
-    
-    if trimTo:
-        seqs = [s[:trimTo] for s in seqs]
+    def run(self, inputL):
+        for roleIndex, (role, fasta) in enumerate(inputL):
+            addL = [getattr(check, feed) for check, feed in self.local[role]]
+            keyL = [(getattr(check, feed), check.addKeyed) for check, feed in self.keyed[role]]
+            if fasta and (addL or keyL):
+                for i, (name, seq) in enumerate(iterFasta(fasta)):
+                    for add in addL:
+                        add(name, seq)
+                    pos = (roleIndex, 0, i)
+                    for key, addKeyed in keyL:
+                        addKeyed(*key(name, seq), pos)
+
+        for check in self.keyedChecks:
+            check.result = check.summary()
+
+    def runSharded(self, inputL, jobs, tmpDir):
+        # Each input is split into byte ranges that are read by separate processes. Local checks are merged in the
+        # order of the pieces. Keyed records are written to one file per piece and partition, by a hash of the key,
+        # and each partition is then summarized by one process
+        global _shared_engine
+        _shared_engine = self
+        context = mp.get_context("fork")
+
+        partFiles = defaultdict(list)
+        for roleIndex, (role, fasta) in enumerate(inputL):
+            if not fasta or not (self.local[role] or self.keyed[role]):
+                continue
+
+            shards = shardFasta(fasta, jobs)
+            # A new pool for each input, so the workers have the results of the inputs before it (i.e., the peptides)
+            with context.Pool(jobs) as pool:
+                partialL = pool.starmap(checkShard, [(roleIndex, role, fasta, shard, start, end, jobs, tmpDir)
+                                                    for shard, (start, end) in enumerate(shards)])
+            for partials in partialL:
+                for (check, feed), partial in zip(self.local[role], partials):
+                    check.merge(partial)
+
+            for check, feed in self.keyed[role]:
+                checkIndex = self.keyedChecks.index(check)
+                for shard in range(len(shards)):
+                    for part in range(jobs):
+                        partFiles[(checkIndex, part)].append(partitionFile(tmpDir, checkIndex, roleIndex, shard, part))
+
+        with context.Pool(jobs) as pool:
+            tasks = sorted(partFiles.items())
+            results = pool.starmap(summarizePartition, [(checkIndex, fileL) for (checkIndex, part), fileL in tasks])
+
+        for check in self.keyedChecks:
+            check.result = check.empty().summary()
+        for ((checkIndex, part), fileL), result in zip(tasks, results):
+            check = self.keyedChecks[checkIndex]
+            check.result = check.mergeResults(check.result, result)
+        _shared_engine = None
+
+# Set in the parent before the pools are forked, so workers can use the registered checks without pickling them
+_shared_engine = None
+
+def checkShard(roleIndex, role, fasta, shard, start, end, numParts, tmpDir):
+    engine = _shared_engine
+    localL = [(check.empty(), feed) for check, feed in engine.local[role]]
+    addL = [getattr(check, feed) for check, feed in localL]
+    keyL = []
+    for check, feed in engine.keyed[role]:
+        checkIndex = engine.keyedChecks.index(check)
+        keyL.append((getattr(check, feed), PartitionWriter([partitionFile(tmpDir, checkIndex, roleIndex, shard, part)
+                                                            for part in range(numParts)])))
+
+    for i, (name, seq) in enumerate(iterFasta(fasta, start, end)):
+        for add in addL:
+            add(name, seq)
+        pos = (roleIndex, shard, i)
+        for key, writer in keyL:
+            writer.write(*key(name, seq), pos)
+
+    for key, writer in keyL:
+        writer.close()
+    for check, feed in localL:
+        if hasattr(check, "flush"):
+            check.flush()
+    return [check for check, feed in localL]
+
+def summarizePartition(checkIndex, fileL):
+    check = _shared_engine.keyedChecks[checkIndex].empty()
+    for filename in fileL:
+        with open(filename, "rb") as fin:
+            while True:
+                try:
+                    itemL = pickle.load(fin)
+                except EOFError:
+                    break
+                for key, value, pos in itemL:
+                    check.addKeyed(key, value, pos)
+        os.remove(filename)
+    return check.summary()
+
+def partitionFile(tmpDir, checkIndex, roleIndex, shard, part):
+    return os.path.join(tmpDir, "%d.%d.%d.%d" % (checkIndex, roleIndex, shard, part))
+
+class PartitionWriter:
+    # Writes (key, value, position) items to one of several files, by a hash of the key, in pickled batches
+
+    batchSize = 10000
+
+    def __init__(self, fileL):
+        self.files = [open(filename, "wb") for filename in fileL]
+        self.batches = [[] for filename in fileL]
+
+    def write(self, key, value, pos):
+        part = zlib.crc32(key.encode()) % len(self.files)
+        self.batches[part].append((key, value, pos))
+        if len(self.batches[part]) == self.batchSize:
+            pickle.dump(self.batches[part], self.files[part])
+            self.batches[part] = []
+
+    def close(self):
+        for batch, fout in zip(self.batches, self.files):
+            if batch:
+                pickle.dump(batch, fout)
+            fout.close()
+
+def shardFasta(fasta, numShards):
+    # Splits a fasta file into about numShards byte ranges, each starting at the beginning of a record
+    size = os.path.getsize(fasta)
+    bounds = [0]
+    with open(fasta, "rb") as fin:
+        for i in range(1, numShards):
+            fin.seek(max(size*i//numShards, bounds[-1]))
+            fin.readline()
+            pos = fin.tell()
+            line = fin.readline()
+            while line and not line.startswith(b">"):
+                pos = fin.tell()
+                line = fin.readline()
+            bounds.append(pos)
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+def iterFasta(fasta, start=0, end=None):
+    # Yields the (name, seq) records of a fasta file, or of the records starting in a byte range of it,
+    # one at a time, in the same form as ft.read_fasta_lists
+    name = None
+    seqL = []
+    with open(fasta, "rb") as fin:
+        fin.seek(start)
+        pos = start
+        for line in fin:
+            if end is not None and pos >= end:
+                break
+            pos += len(line)
+            line = line.decode().strip()
+            if line and line[0] == ">":
+                if name is not None:
+                    yield name, firstWord("".join(seqL))
+                name = line[1:]
+                seqL = []
+            else:
+                seqL.append(line)
+    if name is not None:
+        yield name, firstWord("".join(seqL))
+
+def firstWord(seq):
+    words = seq.split()
+    return words[0] if words else seq
+
+class DistinctCount:
+    # Number of distinct names, or of distinct (trimmed) sequences
+
+    keyed = True
+
+    def __init__(self, field, trimTo=False):
+        self.field = field
+        self.trimTo = trimTo
+        self.seen = set()
+
+    def key(self, name, seq):
+        if self.field == "name":
+            return name, None
+        return (seq[:self.trimTo] if self.trimTo else seq), None
+
+    def empty(self):
+        return DistinctCount(self.field, self.trimTo)
+
+    def addKeyed(self, key, value, pos):
+        self.seen.add(key)
+
+    def summary(self):
+        return len(self.seen)
+
+    def mergeResults(self, result, other):
+        return result+other
+
+class FastaSummary:
+    # Sequence lengths and the uniqueness of names and sequences
+
+    keyed = False
     
-    lengths = set([len(s) for s in seqs])
-    if len(lengths)>1: 
-        fout.write("There are multiple seqeunce lengths in %s: %s\n" % (fasta, ",".join([str(x) for x in lengths])))
-    else:
-        fout.write("All seqs in %s are %d characters long\n" % (fasta, list(lengths)[0]))
+    def __init__(self, fasta, trimTo=False):
+        self.fasta = fasta
+        self.trimTo = trimTo
+        self.numSeqs = 0
+        self.lengths = set()
+        self.uniqN = DistinctCount("name")
+        self.uniqS = DistinctCount("seq", trimTo)
+        self.parts = [self.uniqN, self.uniqS]
+
+    def add(self, name, seq):
+        if self.trimTo:
+            seq = seq[:self.trimTo]
+        self.numSeqs+=1
+        self.lengths.add(len(seq))
+
+    def empty(self):
+        return FastaSummary(self.fasta, self.trimTo)
+
+    def merge(self, other):
+        self.numSeqs+=other.numSeqs
+        self.lengths |= other.lengths
+
+    def report(self, fout):
+        if not self.lengths:
+            fout.write("There are no seqs in %s\n" % (self.fasta))
+        elif len(self.lengths)>1: 
+            fout.write("There are multiple seqeunce lengths in %s: %s\n" % (self.fasta, ",".join([str(x) for x in self.lengths])))
+        else:
+            fout.write("All seqs in %s are %d characters long\n" % (self.fasta, list(self.lengths)[0]))
         
-    uniqN = set(names)
-    uniqS = set(seqs)
+        if self.numSeqs != self.uniqN.result:
+            fout.write("Total Names: %d, Unique Names: %d\n" % (self.numSeqs, self.uniqN.result))
+        else:
+            fout.write("All %d Names are Unique.\n" % (self.numSeqs))
+        if self.numSeqs != self.uniqS.result:
+            fout.write("Total Seqs: %d, Unique Seqs: %d\n\n" % (self.numSeqs, self.uniqS.result))
+        else:
+            fout.write("All %d Seqs are Unique.\n\n" % (self.numSeqs))
+
+class IdenticalSeqs:
+    # Sequences shared by more than one record, and whether those records are for the same peptide
     
-    if len(names) != len(uniqN):
-        fout.write("Total Names: %d, Unique Names: %d\n" % (len(names), len(uniqN)))
-    else:
-        fout.write("All %d Names are Unique.\n" % (len(names)))
-    if len(seqs) != len(uniqS):
-        fout.write("Total Seqs: %d, Unique Seqs: %d\n\n" % (len(seqs), len(uniqS)))
-    else:
-        fout.write("All %d Seqs are Unique.\n\n" % (len(seqs)))
+    keyed = True
 
+    def __init__(self, trimTo=False):
+        self.trimTo = trimTo
+        self.seqD = {}
 
-def findIdentical(fasta, fout, trimTo=False):
-    names, seqs = ft.read_fasta_lists(fasta)
+    def key(self, name, seq):
+        if self.trimTo:
+            seq = seq[:self.trimTo]
+        return seq, name.split("-")[0]
 
-    if trimTo:
-        seqs = [s[:trimTo] for s in seqs]
+    def empty(self):
+        return IdenticalSeqs(self.trimTo)
 
-    seqD = defaultdict(list)
-    
-    for i,s in enumerate(seqs):
-        seqD[s].append(names[i].split("-")[0])
-    
-    multiPeps = 0
-    uniqueEnc = 0
-    uniquePeps = 0
-    
-    for k, v in seqD.items():
-        if len(v) != 1:
-            if len(set(v)) != 1:
-                fout.write("Non-unique seqs!  %s: %s\n" % (k, ", ".join(v)))
-                multiPeps+=1
-            else:
-                uniquePeps+=1
+    def addKeyed(self, key, value, pos):
+        if key in self.seqD:
+            self.seqD[key][1].append(value)
         else:
-            uniqueEnc+=1
+            self.seqD[key] = (pos, [value])
+
+    def summary(self):
+        multiPeps = 0
+        uniqueEnc = 0
+        uniquePeps = 0
+        lines = []
+        
+        for k, (pos, v) in self.seqD.items():
+            if len(v) != 1:
+                if len(set(v)) != 1:
+                    lines.append((pos, "Non-unique seqs!  %s: %s\n" % (k, ", ".join(v))))
+                    multiPeps+=1
+                else:
+                    uniquePeps+=1
+            else:
+                uniqueEnc+=1
+        return [multiPeps, uniqueEnc, uniquePeps, lines]
+        
+    def mergeResults(self, result, other):
+        return [a+b for a, b in zip(result, other)]
+
+    def report(self, fout):
+        multiPeps, uniqueEnc, uniquePeps, lines = self.result
+        fout.writelines([line for pos, line in sorted(lines)])
+        fout.write("%d oligos are linked to multiple peptides\n" % (multiPeps))
+        fout.write("%d oligos are unique\n" % (uniqueEnc))
+        fout.write("%d oligos are present multiple times for the same peptide\n" % (uniquePeps))
+
+class IdenticalNames:
+    # Names used by more than one record
     
-    fout.write("%d oligos are linked to multiple peptides\n" % (multiPeps))
-    fout.write("%d oligos are unique\n" % (uniqueEnc))
-    fout.write("%d oligos are present multiple times for the same peptide\n" % (uniquePeps))
-            
+    keyed = True
+
+    def __init__(self):
+        self.counts = {}
+
+    def key(self, name, seq):
+        return name, None
+
+    def empty(self):
+        return IdenticalNames()
+
+    def addKeyed(self, key, value, pos):
+        if key in self.counts:
+            self.counts[key][1]+=1
+        else:
+            self.counts[key] = [pos, 1]
+
+    def summary(self):
+        return [(pos, "Mutliple identical names: %s, %d ocurrences" % (k, v)) for k, (pos, v) in self.counts.items() if v>1]
+
+    def mergeResults(self, result, other):
+        return result+other
+
+    def report(self, fout):
+        fout.writelines([line for pos, line in sorted(self.result)])
+
+class AdapterCheck:
+    # Whether each encoding starts and ends with the expected adapters
     
-def identNames(fasta, fout):
-    names, seqs = ft.read_fasta_lists(fasta)
-    fD=defaultdict(list)
-    for i in range(len(names)):
-        fD[names[i]].append(seqs[i])
-    for k,v in fD.items():
-        if len(v)>1:
-            fout.write("Mutliple identical names: %s, %d ocurrences" % (k, len(v)))
-            
-def checkAdapters(probes, fout):
-    pN, pS = ft.read_fasta_lists(probes)
+    keyed = False
     ad = {
         "F_Adapter": "CCTATACTTCCAAGGCGCA",
         "R_Adapter": "GGTGACTCTCTGTCTTGGC",
     }
     
-    fC=0
-    rC=0
-    
-    for i in range(len(pN)):
-        if not pS[i].startswith(ad["F_Adapter"]):
-            fout.write("%s doesn't start with Forward adapter (%s): %s\n" % (pN[i], ad["F_Adapter"], pS[i]))
+    def __init__(self):
+        self.numSeqs = 0
+        self.fC = 0
+        self.rC = 0
+        self.lines = []
+
+    def add(self, name, seq):
+        self.numSeqs+=1
+        if not seq.startswith(self.ad["F_Adapter"]):
+            self.lines.append("%s doesn't start with Forward adapter (%s): %s\n" % (name, self.ad["F_Adapter"], seq))
         else:
-            fC+=1
+            self.fC+=1
             
-        if not pS[i].endswith(ad["R_Adapter"]):
-            fout.write("%s doesn't end with Reverse adapter (%s): %s\n" % (pN[i], ad["R_Adapter"], pS[i]))
+        if not seq.endswith(self.ad["R_Adapter"]):
+            self.lines.append("%s doesn't end with Reverse adapter (%s): %s\n" % (name, self.ad["R_Adapter"], seq))
         else:
-            rC+=1
-    
-    if fC == len(pN):
-        fout.write("All encodings (%d) have the proper forward adapter.\n\n" % (fC))
-    if rC == len(pN):
-        fout.write("All encodings (%d) have the proper reverse adapter.\n\n" % (rC))
-    
-def checkTranslation(aaF, ntF, fout):
-    aaD = ft.read_fasta_dict_upper(aaF)
-    ntD = ft.read_fasta_dict_upper(ntF)
-    
-    matchCount=0
-    for name, ntS in ntD.items():
-        expAA = str(Seq(ntS).translate())
-        aaName = name.split("-")[0]
-        if expAA != aaD[aaName]:
-            fout.write("%s does not translate to %s\n" % (ntS, aaD[aaName]))
-        else:
-            matchCount+=1
+            self.rC+=1
+
+    def empty(self):
+        return AdapterCheck()
+
+    def merge(self, other):
+        self.numSeqs+=other.numSeqs
+        self.fC+=other.fC
+        self.rC+=other.rC
+        self.lines+=other.lines
+
+    def report(self, fout):
+        fout.writelines(self.lines)
+        if self.fC == self.numSeqs:
+            fout.write("All encodings (%d) have the proper forward adapter.\n\n" % (self.fC))
+        if self.rC == self.numSeqs:
+            fout.write("All encodings (%d) have the proper reverse adapter.\n\n" % (self.rC))
+
+# Standard genetic code, indexed by 16*first + 4*second + third nucleotide, with A=0, C=1, G=2, T=3
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+BASE_CODES[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4)
+CODON_TABLE = np.frombuffer(b"KNKNTTTTRSRSIIMIQHQHPPPPRRRRLLLLEDEDAAAAGGGGVVVV*Y*YSSSS*CWCLFLF", dtype=np.uint8)
+
+def seqArray(seqL):
+    # 2D uint8 array from a list of equal length sequences
+    return np.frombuffer("".join(seqL).encode("ascii", "replace"), dtype=np.uint8).reshape(len(seqL), -1)
+
+def byLength(seqL):
+    # Indices of the sequences in seqL, grouped by length
+    groups = defaultdict(list)
+    for i, s in enumerate(seqL):
+        groups[len(s)].append(i)
+    return groups.items()
+
+class PeptideDict:
+    # The peptide sequences, by name, for checking translations
+
+    keyed = False
+
+    def __init__(self):
+        self.aaD = {}
+
+    def add(self, name, seq):
+        self.aaD[name] = seq.upper()
+
+    def empty(self):
+        return PeptideDict()
+
+    def merge(self, other):
+        self.aaD.update(other.aaD)
+
+class TranslationCheck:
+    # Whether each encoding translates to its peptide. All of the peptides must be added before the encodings.
+    # Encodings are translated in batches of equal length through CODON_TABLE.
+    # When a name is repeated, the last encoding with that name is the one checked, in the position of the first
+    
+    keyed = False
+    batchSize = 50000
+    
+    def __init__(self, peptides):
+        self.peptides = peptides
+        self.results = {}
+        self.batch = []
+
+    def add(self, name, seq):
+        aaS = self.peptides.aaD[name.split("-")[0]]
+        self.results.setdefault(name, None)
+        self.batch.append((name, seq.upper(), aaS))
+        if len(self.batch) == self.batchSize:
+            self.flush()
+
+    def flush(self):
+        nameL, ntL, aaL = zip(*self.batch) if self.batch else ([], [], [])
+        matchL = [False]*len(nameL)
+        
+        for length, idx in byLength(ntL):
+            numCodons = length//3
+            codes = BASE_CODES[seqArray([ntL[i] for i in idx])[:, :numCodons*3]].reshape(len(idx), numCodons, 3)
+            valid = (codes != 255).all(axis=(1, 2))
+            
+            # Only peptides of the right length can match
+            use = valid & np.array([len(aaL[i]) == numCodons for i in idx])
+            if use.any():
+                useIdx = np.array(idx)[use]
+                codes = codes[use].astype(np.intp)
+                expAA = CODON_TABLE[(codes[:, :, 0]<<4) | (codes[:, :, 1]<<2) | codes[:, :, 2]]
+                for i, match in zip(useIdx, (expAA == seqArray([aaL[i] for i in useIdx])).all(axis=1)):
+                    matchL[i] = bool(match)
+            
+            # Encodings with other characters are translated one at a time
+            for i, ok in zip(idx, valid):
+                if not ok:
+                    matchL[i] = translate(ntL[i]) == aaL[i]
+        
+        for name, ntS, aaS, match in zip(nameL, ntL, aaL, matchL):
+            self.results[name] = None if match else "%s does not translate to %s\n" % (ntS, aaS)
+        self.batch = []
+
+    def empty(self):
+        return TranslationCheck(self.peptides)
+
+    def merge(self, other):
+        self.results.update(other.results)
+
+    def __getstate__(self):
+        # The peptides are not sent back from the workers
+        state = self.__dict__.copy()
+        state["peptides"] = None
+        return state
+
+    def report(self, fout):
+        self.flush()
+        matchCount = 0
+        for line in self.results.values():
+            if line:
+                fout.write(line)
+            else:
+                matchCount+=1
+        
+        if matchCount == len(self.results):
+            fout.write("All encodings (%d) match expected AA sequence.\n\n" % (matchCount))
+
+class NucsMatchCheck:
+    # Whether each encoding with adapters matches the encoding without them, keyed by name.
+    # All of the encodings without adapters must be added first, which they are as they come from an earlier input
+
+    keyed = True
     
-    if matchCount == len(ntD):
-        fout.write("All encodings (%d) match expected AA sequence.\n\n" % (matchCount))
+    def __init__(self):
+        self.ntD = {}
+        self.results = {}
+
+    def ntKey(self, name, seq):
+        return name, ("nt", seq.upper())
+
+    def adKey(self, name, seq):
+        return name, ("ad", seq.upper()[19:-19])
+
+    def empty(self):
+        return NucsMatchCheck()
+
+    def addKeyed(self, key, value, pos):
+        source, seq = value
+        if source == "nt":
+            if key in self.ntD:
+                self.ntD[key][1] = seq
+            else:
+                self.ntD[key] = [pos, seq]
+        elif key in self.ntD:
+            ntS = self.ntD[key][1]
+            self.results[key] = "%s does not match %s\n" % (ntS, seq) if seq != ntS else None
+
+    def summary(self):
+        matchCount = 0
+        lines = []
+        for name, (pos, ntS) in self.ntD.items():
+            line = self.results[name]
+            if line:
+                lines.append((pos, line))
+            else:
+                matchCount+=1
+        return [matchCount, len(self.ntD), lines]
+
+    def mergeResults(self, result, other):
+        return [a+b for a, b in zip(result, other)]
+
+    def report(self, fout):
+        matchCount, numNt, lines = self.result
+        fout.writelines([line for pos, line in sorted(lines)])
+        
+        if matchCount == numNt:
+            fout.write("All encodings with adapters (%d) match the encodings without adapters.\n\n" % (matchCount))
+
+def translate(ntS):
+    if Seq:
+        return str(Seq(ntS).translate())
+    aaL = []
+    for i in range(0, len(ntS)-len(ntS)%3, 3):
+        codes = BASE_CODES[np.frombuffer(ntS[i:i+3].encode("ascii", "replace"), dtype=np.uint8)]
+        aaL.append("X" if (codes == 255).any() else chr(CODON_TABLE[16*int(codes[0])+4*int(codes[1])+int(codes[2])]))
+    return "".join(aaL)
+
+class GCValues:
+    # GC proportion of each sequence, for plotting. Calculated in batches of equal length sequences
+    
+    keyed = False
+    batchSize = 50000
+    
+    def __init__(self):
+        self.arrays = []
+        self.batch = []
+
+    def add(self, name, seq):
+        self.batch.append(seq)
+        if len(self.batch) == self.batchSize:
+            self.flush()
+
+    def flush(self):
+        values = np.zeros(len(self.batch))
+        for length, idx in byLength(self.batch):
+            values[idx] = np.isin(seqArray([self.batch[i] for i in idx]), GC_CODES).sum(axis=1)/length
+        self.arrays.append(values)
+        self.batch = []
+
+    def empty(self):
+        return GCValues()
+
+    def merge(self, other):
+        self.arrays+=other.arrays
+
+    @property
+    def values(self):
+        self.flush()
+        return np.concatenate(self.arrays)
 
-def gc(seq):
-    return (seq.count("C")+seq.count("G"))/len(seq)
+GC_CODES = np.frombuffer(b"CG", dtype=np.uint8)
 
 
 ###---------------------------->>>
@@ -5,20 +5,21 @@
 # Used to select final encodings for PepSeq libraries
 
 import argparse
-import itertools as it
+import os
+import numpy as np
 import inout as io               #Available at https://github.com/jtladner/Modules
 import fastatools as ft          #Available at https://github.com/jtladner/Modules
 import kmertools as kt          #Available at https://github.com/jtladner/Modules
 
-from collections import defaultdict
+from collections import defaultdict, deque
 
 def main():
 
     #To parse command line
     p = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     
-    p.add_argument('-x', '--extraEnc', help='Optional file that is of the same type provided with the -e flag, but including a greater number of encodings per peptide.')
-    p.add_argument('-t', '--truncLen', type=int, default=40, help='Length of truncated encoding to test for uniqueness.')
+    p.add_argument('-x', '--extraEnc', help='Optional file that is of the same type provided with the -e flag, but including a greater number of encodings per peptide. The first time it is used, an index of the rows for each peptide is saved next to it as "{extraEnc}.idx".')
+    p.add_argument('-t', '--truncLen', type=int, nargs='+', default=[40], help='Length of truncated encoding to test for uniqueness. If more than one length is provided, a separate set of output files is generated for each, with "_t{length}" added to the base name.')
 
     reqArgs = p.add_argument_group('required arguments')
     reqArgs.add_argument('-e', '--enc', help='CSV-formatted file generated by encoding_with_nn.py.', required=True)
@@ -27,18 +28,35 @@ def main():
     args = p.parse_args()
     
     # Read in encodings and select the top scoring encoding for each peptide
-    topEnc, topEncAdapt, encLD, truncLD = readEncodings(args.enc, args)
-    topEncTrunc = {v[:args.truncLen]:k for k,v in topEnc.items()}
+    encTable = EncodingTable(args.enc)
+    topEnc = encTable.topEncodings()
+    prefixIndex = PrefixIndex(encTable)
+    extraIndex = ExtraEncIndex(args.extraEnc) if args.extraEnc else None
+
+    for truncLen in args.truncLen:
+        if len(args.truncLen) > 1:
+            print(f"Selecting encodings with truncated length {truncLen}.\n")
+            outBase = f"{args.out}_t{truncLen}"
+        else:
+            outBase = args.out
+        selectForTruncLen(truncLen, outBase, dict(topEnc), encTable, prefixIndex, extraIndex)
+
+###-----------------End of main()--------------------------->>>
+
+def selectForTruncLen(truncLen, outBase, topEnc, encTable, prefixIndex, extraIndex):
+
+    encLD = TruncatedOptions(encTable, truncLen)
+    topEncTrunc = {v[:truncLen]:k for k,v in topEnc.items()}
     
     # Generate dictionary with truncated encodings as keys and lists of codenames as values
     topTruncD = defaultdict(list)
     for k,v in topEnc.items():
-        topTruncD[v[:args.truncLen]].append((k, v, topEncAdapt[k]))
+        topTruncD[v[:truncLen]].append((k, v))
     
     # Check to see if all truncated encodings are unique and, if they are, then generate output files
     if len(topTruncD) == len(topEnc):
         print(f"No encoding conflicts. Writing output files.\n")
-        write_output_fastas(topEnc, topEncAdapt, args)
+        write_output_fastas(topEnc, encTable.adapters, outBase)
     
     # If there are some peptides with identical encodings when truncated
     elif len(topTruncD) < len(topEnc):
@@ -46,15 +64,14 @@ def main():
         # Remove redundant encodings from the output fasta files
         for k, v in topTruncD.items():
             if len(v) > 1:
-                del(topEncTrunc[topEnc[v[0][0]][:args.truncLen]])
+                del(topEncTrunc[topEnc[v[0][0]][:truncLen]])
                 for eachV in v:
                     del(topEnc[eachV[0]])
-                    del(topEncAdapt[eachV[0]])
                 
         
         # Remove unique encodings from the topTruncD dictionary
         for v in topEnc.values():
-            del(topTruncD[v[:args.truncLen]])
+            del(topTruncD[v[:truncLen]])
 
         print(f"\nAttempting to resolve {len(topTruncD)} conflicts with initial options.\n")
 
@@ -63,7 +80,7 @@ def main():
 
         for seq, nameL in topTruncD.items():
             # Check for universally unique encodings
-            univUniqL = [checkForUnivUniq(encLD[n], truncLD) for n in [y[0] for y in nameL]]
+            univUniqL = [checkForUnivUniq(encLD[n], encTable.rows(n), prefixIndex, truncLen) for n in [y[0] for y in nameL]]
             numUnivUniq = sum([1 for x in univUniqL if x])
     
             # If all peptides or all except one have universally unique encoding options
@@ -72,14 +89,11 @@ def main():
                     name = info[0]
                     if univUniqL[i]:
                         newFull = univUniqL[i][1]
-                        newAdapt = univUniqL[i][2]
                     else:
                         newFull  = info[1]
-                        newAdapt = info[2]
                         
                     topEnc[name] = newFull
-                    topEncAdapt[name] = newAdapt
-                    topEncTrunc[newFull[:40]] = name
+                    topEncTrunc[newFull[:truncLen]] = name
 
             # If more than one peptide lacks a universally unique encoding option
             else:
@@ -89,10 +103,8 @@ def main():
                     name = info[0]
                     if univUniqL[i]:
                         newFull = univUniqL[i][1]
-                        newAdapt = univUniqL[i][2]
                         topEnc[name] = newFull
-                        topEncAdapt[name] = newAdapt
-                        topEncTrunc[newFull[:40]] = name
+                        topEncTrunc[newFull[:truncLen]] = name
                     else:
                         newNameL.append(info)
 
@@ -102,17 +114,17 @@ def main():
 
         to_indepth = []
         for newNameL in to_deconv:
-            forFurther = searchForUniqCombo(newNameL, encLD, topEnc, topEncTrunc, topEncAdapt)
+            forFurther = resolveConflicts(newNameL, encLD, topEnc, topEncTrunc)
             to_indepth += forFurther
 
         if not to_indepth:
-            if len(topEnc) == len(topEncAdapt):
+            if len(topEnc) == len(encTable.names):
                 print(f"Was able to resolve all conflicts with initial encodings. Now writing output files.\n")
-                write_output_fastas(topEnc, topEncAdapt, args)
+                write_output_fastas(topEnc, encTable.adapters, outBase)
             else:
                 print(f"There is a problem.\n")
             
-        elif args.extraEnc:
+        elif extraIndex:
             print(f"\nMoving to extra encodings to resolve {len(to_indepth)} conflicts.\n")
             
             # Make dict with keys for the target peptides, to extract info from the extra encodings file
@@ -122,31 +134,26 @@ def main():
                     targets[every[0]] = ""
 
             encLD = defaultdict(list)
-            truncLD = defaultdict(list)
             
             # Read in encodings for the remaining peptides with conflicts
-            with open(args.extraEnc, "r") as fin:
-                next(fin)
-                for line in fin:
-                    cols = line.rstrip("\n").split(",")
-                    seqID = cols[0]
-                    
-                    simpN = "_".join(seqID.split("_")[:2])
-                    if simpN in targets:        
-                        encSeq = cols[2]
-                        encSeqAdapt = cols[7]
-                        encLD[simpN].append((encSeq[:args.truncLen], encSeq, encSeqAdapt))
-                        truncLD[encSeq[:args.truncLen]].append(simpN)
+            for line in extraIndex.readRows(targets):
+                cols = line.rstrip("\n").split(",")
+                seqID = cols[0]
+                
+                simpN = "_".join(seqID.split("_")[:2])
+                encSeq = cols[2]
+                encTable.checkAdapters(seqID, encSeq, cols[7])
+                encLD[simpN].append((encSeq[:truncLen], encSeq))
 
             stillProb = []
             for newNameL in to_indepth:
-                forFurther = searchForUniqCombo(newNameL, encLD, topEnc, topEncTrunc, topEncAdapt)
+                forFurther = resolveConflicts(newNameL, encLD, topEnc, topEncTrunc)
                 stillProb += forFurther
             
             if not stillProb:
-                if len(topEnc) == len(topEncAdapt):
+                if len(topEnc) == len(encTable.names):
                     print(f"Was able to resolve all conflicts using additional encodings. Now writing output files with {len(topEnc)} sequences.")
-                    write_output_fastas(topEnc, topEncAdapt, args)
+                    write_output_fastas(topEnc, encTable.adapters, outBase)
 
                 else:
                     print(f"There is a problem.")
@@ -157,100 +164,397 @@ def main():
     else:
         print(f"Something is wrong. There are more keys in the topTruncD ({len(topTruncD)} than in in the topEnc ({len(topEnc)})")
     
-###-----------------End of main()--------------------------->>>
-
-def write_output_fastas(encD, adaptD, args):
-    ft.write_fasta_dict(encD, f"{args.out}.fna")
-    ft.write_fasta_dict(adaptD, f"{args.out}_wAdapters.fna")
 
-def readEncodings(encFile, args):
-
-    encLD = defaultdict(list)
-    truncLD = defaultdict(list)
+def write_output_fastas(encD, adapters, outBase):
+    prefix, suffix = adapters
+    ft.write_fasta_dict(encD, f"{outBase}.fna")
+    ft.write_fasta_dict({k:f"{prefix}{v}{suffix}" for k,v in encD.items()}, f"{outBase}_wAdapters.fna")
+
+# 2-bit codes for each nucleotide, 255 for anything else
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+BASE_CODES = np.full(256, 255, dtype=np.uint8)
+BASE_CODES[BASES] = np.arange(4)
+SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8)
+
+class EncodingTable:
+    # Every encoding of every peptide in an encodings file, packed 4 nucleotides to a byte and grouped by peptide.
+    # Within each peptide, rows keep their order from the file. The adapters are the same for every encoding,
+    # so they are stored once and only added to the encodings on output
     
-    topEnc = {}
-    topEncAdapt = {}
-    topScore = {}
+    batchSize = 100000
     
-    with open(encFile, "r") as fin:
-        next(fin)
-        for line in fin:
-
-            cols = line.rstrip("\n").split(",")
-
-            seqID = cols[0]
-            simpN = "_".join(seqID.split("_")[:2])
-            encSeq = cols[2]
-            encSeqAdapt = cols[7]
-            score = float(cols[6])
-            
-            # Check to see if this is the best scoring ecoding for this peptide
-            if simpN not in topEnc:
-                topEnc[simpN] = encSeq
-                topEncAdapt[simpN] = encSeqAdapt
-                topScore[simpN] = score
-            elif score < topScore[simpN]:
-                topEnc[simpN] = encSeq
-                topEncAdapt[simpN] = encSeqAdapt
-                topScore[simpN] = score
+    def __init__(self, encFile):
+        self.names = []
+        self.nameIndex = {}
+        self.adapters = None
+        
+        packedL, lengthL, ownerL, scoreL = [], [], [], []
+        encL, owners, scores = [], [], []
+        with open(encFile, "r") as fin:
+            next(fin)
+            for line in fin:
+
+                cols = line.rstrip("\n").split(",")
+
+                seqID = cols[0]
+                simpN = "_".join(seqID.split("_")[:2])
+                encSeq = cols[2]
+                encSeqAdapt = cols[7]
                 
-            
-            encLD[simpN].append((encSeq[:args.truncLen], encSeq, encSeqAdapt))
-            truncLD[encSeq[:args.truncLen]].append(simpN)
+                if self.adapters is None:
+                    start = encSeqAdapt.find(encSeq)
+                    self.adapters = (encSeqAdapt[:start], encSeqAdapt[start+len(encSeq):])
+                self.checkAdapters(seqID, encSeq, encSeqAdapt)
+                
+                if simpN not in self.nameIndex:
+                    self.nameIndex[simpN] = len(self.names)
+                    self.names.append(simpN)
+                encL.append(encSeq)
+                owners.append(self.nameIndex[simpN])
+                scores.append(float(cols[6]))
+                
+                if len(encL) == self.batchSize:
+                    packedL.append(packEncodings(encL))
+                    lengthL.append(np.array([len(e) for e in encL], dtype=np.uint16))
+                    ownerL.append(np.array(owners, dtype=np.int32))
+                    scoreL.append(np.array(scores, dtype=np.float64))
+                    encL, owners, scores = [], [], []
+        
+        if encL:
+            packedL.append(packEncodings(encL))
+            lengthL.append(np.array([len(e) for e in encL], dtype=np.uint16))
+            ownerL.append(np.array(owners, dtype=np.int32))
+            scoreL.append(np.array(scores, dtype=np.float64))
+        if not packedL:
+            raise ValueError(f"No encodings found in {encFile}.")
+
+        width = max([packed.shape[1] for packed in packedL])
+        packed = np.concatenate([np.pad(packed, ((0, 0), (0, width-packed.shape[1]))) for packed in packedL])
+        owners = np.concatenate(ownerL)
+        
+        # Group the rows by peptide
+        order = np.argsort(owners, kind="stable")
+        self.packed = packed[order]
+        self.lengths = np.concatenate(lengthL)[order]
+        self.owners = owners[order]
+        self.scores = np.concatenate(scoreL)[order]
+        self.starts = np.searchsorted(self.owners, np.arange(len(self.names)+1))
+
+    def rows(self, name):
+        i = self.nameIndex[name]
+        return np.arange(self.starts[i], self.starts[i+1])
+
+    def decode(self, rows):
+        codes = (self.packed[rows][:, :, None] >> SHIFTS) & 3
+        seqs = BASES[codes].reshape(len(rows), -1)
+        return [seqs[i, :length].tobytes().decode() for i, length in enumerate(self.lengths[rows])]
+
+    def topEncodings(self):
+        # Returns a dict of the best scoring (lowest) encoding for each peptide, in the order the peptides appear in the file.
+        # Ties go to the first encoding in the file
+        best = np.lexsort((self.scores, self.owners))[self.starts[:-1]]
+        return dict(zip(self.names, self.decode(best)))
+
+    def prefixKeys(self, rows, truncLen):
+        # Fixed-width byte strings that are equal only for encodings with the same first truncLen nucleotides.
+        # The length of the truncated encoding is included, followed by a non-null byte so numpy keeps trailing nulls
+        numBytes = -(-truncLen//4)
+        keys = self.packed[rows, :numBytes].copy()
+        if keys.shape[1] < numBytes:
+            keys = np.pad(keys, ((0, 0), (0, numBytes-keys.shape[1])))
+        if truncLen % 4:
+            keys[:, -1] &= (0xFF << 2*(4-truncLen%4)) & 0xFF
+        lengths = np.minimum(self.lengths[rows], truncLen).astype(">u2").view(np.uint8).reshape(-1, 2)
+        keys = np.hstack([keys, lengths, np.ones((len(keys), 1), dtype=np.uint8)])
+        return np.ascontiguousarray(keys).view(f"S{numBytes+3}").ravel()
+
+    def checkAdapters(self, seqID, encSeq, encSeqAdapt):
+        # Encodings are only stored without their adapters, so any row whose adapters differ is rejected
+        if encSeqAdapt != f"{self.adapters[0]}{encSeq}{self.adapters[1]}":
+            raise ValueError(f"The encoding for {seqID} does not have the same adapters as the other encodings.")
+
+def packEncodings(encL):
+    width = -(-max([len(e) for e in encL])//4)*4
+    codes = BASE_CODES[np.frombuffer("".join([e.ljust(width, "A") for e in encL]).encode(), dtype=np.uint8)]
+    if (codes == 255).any():
+        raise ValueError("Encodings may only contain the nucleotides A, C, G and T.")
+    codes = codes.reshape(len(encL), width//4, 4)
+    return (codes[:, :, 0]<<6) | (codes[:, :, 1]<<4) | (codes[:, :, 2]<<2) | codes[:, :, 3]
+
+class TruncatedOptions:
+    # The ( truncated encoding, encoding ) options for each peptide, decoded from an EncodingTable as they are needed
+    
+    def __init__(self, encTable, truncLen):
+        self.encTable = encTable
+        self.truncLen = truncLen
 
-    return topEnc, topEncAdapt, encLD, truncLD
+    def __getitem__(self, name):
+        return [(encSeq[:self.truncLen], encSeq) for encSeq in self.encTable.decode(self.encTable.rows(name))]
 
-def checkForUnivUniq(options, seqNameLD):
-    for each in options:
-        if len(set(seqNameLD[each[0]])) == 1:
+class PrefixIndex:
+    # Truncated versions of every candidate encoding, stored as sorted fixed-width byte strings,
+    # along with the number of distinct peptides that have each truncated encoding.
+    # Sorted for each truncated length as it is needed
+    
+    def __init__(self, encTable):
+        self.encTable = encTable
+        self.views = {}
+
+    def view(self, truncLen):
+        if truncLen not in self.views:
+            keys = self.encTable.prefixKeys(slice(None), truncLen)
+            owners = self.encTable.owners
+            order = np.lexsort((owners, keys))
+            keys = keys[order]
+            owners = owners[order]
+            
+            # Keep one entry for each truncated encoding/peptide pair, then count the entries for each truncated encoding
+            first = np.ones(len(keys), dtype=bool)
+            first[1:] = (keys[1:] != keys[:-1]) | (owners[1:] != owners[:-1])
+            self.views[truncLen] = np.unique(keys[first], return_counts=True)
+        return self.views[truncLen]
+
+    def numOwners(self, rows, truncLen):
+        # Returns the number of distinct peptides with the truncated encodings of the given rows
+        keys, counts = self.view(truncLen)
+        query = self.encTable.prefixKeys(rows, truncLen)
+        pos = np.minimum(np.searchsorted(keys, query), len(keys)-1)
+        return np.where(keys[pos] == query, counts[pos], 0)
+
+class ExtraEncIndex:
+    # Byte ranges of the rows for each peptide in an encodings file, so the rows for a few peptides can be read without
+    # scanning the whole file. Runs of consecutive rows are stored as a single range.
+    # The index is saved next to the encodings file and rebuilt if the file's size or modification time change
+    
+    def __init__(self, encFile):
+        self.encFile = encFile
+        self.idxFile = f"{encFile}.idx"
+        self.ranges = None
+
+    def stamp(self):
+        info = os.stat(self.encFile)
+        return f"#{info.st_size}\t{info.st_mtime_ns}"
+
+    def load(self):
+        if self.ranges is not None:
+            return self.ranges
+        
+        if os.path.exists(self.idxFile):
+            with open(self.idxFile, "r") as fin:
+                if fin.readline().rstrip("\n") == self.stamp():
+                    self.ranges = defaultdict(list)
+                    for line in fin:
+                        simpN, start, end = line.rstrip("\n").split("\t")
+                        self.ranges[simpN].append((int(start), int(end)))
+                    return self.ranges
+        
+        self.ranges = self.build()
+        try:
+            with open(f"{self.idxFile}.tmp", "w") as fout:
+                fout.write(f"{self.stamp()}\n")
+                for simpN, rangeL in self.ranges.items():
+                    for start, end in rangeL:
+                        fout.write(f"{simpN}\t{start}\t{end}\n")
+            os.replace(f"{self.idxFile}.tmp", self.idxFile)
+        except OSError as e:
+            print(f"Unable to save index for {self.encFile}: {e}")
+        return self.ranges
+
+    def build(self):
+        print(f"Indexing {self.encFile}.\n")
+        ranges = defaultdict(list)
+        with open(self.encFile, "rb") as fin:
+            pos = len(fin.readline())
+            for line in fin:
+                seqID = line.split(b",", 1)[0].decode()
+                simpN = "_".join(seqID.split("_")[:2])
+                rangeL = ranges[simpN]
+                if rangeL and rangeL[-1][1] == pos:
+                    rangeL[-1] = (rangeL[-1][0], pos+len(line))
+                else:
+                    rangeL.append((pos, pos+len(line)))
+                pos += len(line)
+        return ranges
+
+    def readRows(self, targets):
+        # Yields the rows for the peptides in targets, in the order they appear in the file
+        ranges = self.load()
+        rangeL = sorted([r for simpN in targets for r in ranges.get(simpN, [])])
+        with open(self.encFile, "rb") as fin:
+            for start, end in rangeL:
+                fin.seek(start)
+                for line in fin.read(end-start).decode().splitlines():
+                    yield line
+
+def checkForUnivUniq(options, rows, prefixIndex, truncLen):
+    if not options:
+        return None
+    numOwners = prefixIndex.numOwners(rows, truncLen)
+    for each, num in zip(options, numOwners):
+        if num == 1:
             return each
 
-def searchForUniqCombo(newNameL, encLD, outD, outD_trunc, outAdapt):
+def resolveConflicts(newNameL, encLD, outD, outD_trunc):
+    # Treats the peptides in newNameL and their truncated encoding options as a bipartite graph,
+    # leaving out any truncated encodings that are already in the design.
+    # The chosen options are those of a conflict-free assignment that uses the fewest of the
+    # lower scoring options: the deepest option used is as shallow as possible, then the sum of the option ranks is minimized
     forFurther = []
-    combos = []
-    foundSolution = 0
-    for i in range(1, len(encLD[newNameL[0][0]])):
-        indexOptions = list(range(i+1))
-        indexCombos = list(it.product(indexOptions, repeat=len(newNameL)))
-        for thisOne in indexCombos:
-
-#            This version was replaced with the following for loop to handle situations where there is a different number of encodings for different peptides
-#            truncList = [encLD[newNameL[pos][0]][j][0] for pos, j in enumerate(thisOne)]
-            
-            truncList = []
-            for pos, j in enumerate(thisOne):
-                try:
-                    truncList.append(encLD[newNameL[pos][0]][j][0])
-                except:
-                    break
-
-            if len(truncList) == len(thisOne):
-                # If all truncated peptides are unique
-                if len(truncList)==len(set(truncList)):
-                    # If none of these trunc peptides are already in the design
-                    if len(truncList)==sum([1 for tp in truncList if tp not in outD_trunc]):
-                        foundSolution=thisOne
-
-                        for k, encNum in enumerate(thisOne):
-                            name = newNameL[k][0]
-                            newFull = encLD[name][encNum][1]
-                            newAdapt = encLD[name][encNum][2]
-                            outD[name] = newFull
-                            outAdapt[name] = newAdapt
-                            outD_trunc[newFull[:40]] = name
-                        break
-
-        if foundSolution:
-            #print("Good", foundSolution, len(newNameL))
-            break
+    names = [x[0] for x in newNameL]
+    
+    # Edges from each peptide to its truncated options, weighted by the rank of the best encoding with that truncation
+    truncIndex = {}
+    edgeL = []
+    for name in names:
+        edges = {}
+        for rank, each in enumerate(encLD[name]):
+            if each[0] not in outD_trunc and each[0] not in edges:
+                edges[each[0]] = rank
+        edgeL.append({truncIndex.setdefault(t, len(truncIndex)):rank for t, rank in edges.items()})
+    
+    maxRank = max([r for edges in edgeL for r in edges.values()], default=-1)
     
-    if not foundSolution:
+    # Binary search for the smallest maximum rank that still allows every peptide to be assigned
+    lo, hi = 0, maxRank
+    if hopcroftKarp(edgeL, len(truncIndex), maxRank) < len(names):
+        lo = maxRank+1
+    while lo < hi:
+        mid = (lo+hi)//2
+        if hopcroftKarp(edgeL, len(truncIndex), mid) == len(names):
+            hi = mid
+        else:
+            lo = mid+1
+    
+    if lo > maxRank:
         forFurther.append(newNameL)
-        names = ",".join([x[0] for x in newNameL])
-        print(f"No solution for {names} with initial encodings.")
+        print(f"No solution for {','.join(names)} with initial encodings.")
+        return forFurther
     
+    for i, option in enumerate(minCostAssignment(edgeL, lo)):
+        name = names[i]
+        rank = edgeL[i][option]
+        truncEnc, newFull = encLD[name][rank]
+        outD[name] = newFull
+        outD_trunc[truncEnc] = name
+
     return forFurther
 
+def hopcroftKarp(edgeL, numRight, maxRank):
+    # Returns the size of a maximum matching between peptides and truncated options, using only edges with rank <= maxRank
+    adj = [[t for t, rank in edges.items() if rank <= maxRank] for edges in edgeL]
+    matchL = [-1]*len(adj)
+    matchR = [-1]*numRight
+    size = 0
+    
+    while True:
+        # Layer the free peptides and everything reachable from them by alternating paths
+        dist = [-1]*len(adj)
+        queue = deque()
+        for u in range(len(adj)):
+            if matchL[u] == -1:
+                dist[u] = 0
+                queue.append(u)
+        found = False
+        while queue:
+            u = queue.popleft()
+            for t in adj[u]:
+                v = matchR[t]
+                if v == -1:
+                    found = True
+                elif dist[v] == -1:
+                    dist[v] = dist[u]+1
+                    queue.append(v)
+        if not found:
+            return size
+        
+        # Augment along vertex-disjoint shortest paths. The search is iterative, as paths can be as long as the group.
+        # stack holds each peptide on the current path and the position of the next option to try from it,
+        # and via[i] is the option leading from stack[i] to stack[i+1]
+        def augment(root):
+            stack = [[root, 0]]
+            via = []
+            while stack:
+                u, i = stack[-1]
+                if i == len(adj[u]):
+                    # no augmenting path through u in this phase
+                    dist[u] = -1
+                    stack.pop()
+                    if via:
+                        via.pop()
+                    continue
+                stack[-1][1] += 1
+                t = adj[u][i]
+                v = matchR[t]
+                if v == -1:
+                    via.append(t)
+                    for (w, _), option in zip(stack, via):
+                        matchL[w] = option
+                        matchR[option] = w
+                    return True
+                if dist[v] == dist[u]+1:
+                    via.append(t)
+                    stack.append([v, 0])
+            return False
+        
+        for u in range(len(adj)):
+            if matchL[u] == -1 and augment(u):
+                size += 1
+
+def minCostAssignment(edgeL, maxRank):
+    # Hungarian algorithm over peptides (rows) and truncated options (columns), using only edges with rank <= maxRank.
+    # Assumes a complete assignment exists and returns the chosen option for each peptide
+    columns = sorted({t for edges in edgeL for t, rank in edges.items() if rank <= maxRank})
+    n, m = len(edgeL), len(columns)
+    missing = (maxRank+1)*(n+1)
+    cost = [[missing]*m for _ in range(n)]
+    for i, edges in enumerate(edgeL):
+        for j, t in enumerate(columns):
+            if t in edges and edges[t] <= maxRank:
+                cost[i][j] = edges[t]
+    
+    u = [0]*(n+1)
+    v = [0]*(m+1)
+    p = [0]*(m+1)
+    way = [0]*(m+1)
+    for i in range(1, n+1):
+        p[0] = i
+        j0 = 0
+        minv = [float("inf")]*(m+1)
+        used = [False]*(m+1)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            delta = float("inf")
+            j1 = 0
+            for j in range(1, m+1):
+                if not used[j]:
+                    cur = cost[i0-1][j-1]-u[i0]-v[j]
+                    if cur < minv[j]:
+                        minv[j] = cur
+                        way[j] = j0
+                    if minv[j] < delta:
+                        delta = minv[j]
+                        j1 = j
+            for j in range(m+1):
+                if used[j]:
+                    u[p[j]] += delta
+                    v[j] -= delta
+                else:
+                    minv[j] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+    
+    assignment = [None]*n
+    for j in range(1, m+1):
+        if p[j]:
+            assignment[p[j]-1] = columns[j-1]
+    return assignment
+
 
 ###------------->>>
 
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+import os
+import sys
+import tempfile
+import types
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Imported by qcOligos, but not needed by the checks, so they need not be installed to run these tests
+for module in ["inout", "fastatools"]:
+    try:
+        __import__(module)
+    except ImportError:
+        sys.modules[module] = types.ModuleType(module)
+
+import qcOligos
+
+class EmptyInputTest(unittest.TestCase):
+    def runQC(self, jobs):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            files = {}
+            for opt in ["-p", "-n", "-a"]:
+                files[opt] = os.path.join(tmpDir, "empty%s.fasta" % opt[1])
+                open(files[opt], "w").close()
+            logFile = os.path.join(tmpDir, "qcOligos.log")
+
+            argv = sys.argv
+            sys.argv = ["qcOligos.py", "-l", logFile, "-o", os.path.join(tmpDir, "gc.png"), "-j", str(jobs)]
+            for opt, name in files.items():
+                sys.argv += [opt, name]
+            try:
+                qcOligos.main()
+            finally:
+                sys.argv = argv
+
+            # without the temporary directory, so logs from different runs can be compared
+            with open(logFile) as fin:
+                return fin.read().replace(tmpDir + os.sep, "")
+
+    def test_empty_fastas(self):
+        log = self.runQC(1)
+        self.assertEqual(log.count("There are no seqs in"), 4)
+        self.assertIn("All 0 Names are Unique.", log)
+        self.assertIn("All 0 Seqs are Unique.", log)
+
+    def test_empty_fastas_sharded(self):
+        self.assertEqual(self.runQC(2), self.runQC(1))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,7 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
-from __future__ import division
 import optparse, os
+import numpy as np
 #from subprocess import Popen, PIPE
 #from Bio.Seq import Seq
 #from Bio.Alphabet import generic_dna
@@ -17,82 +17,218 @@ def main():
     p.add_option('-o', '--out',  help='base name for output files. [None, REQ]')
     p.add_option('-k', '--kmers', default="5,6,7,8,9,10,11,12", help='Comma-delimited string of kmer sizes to check. [5,6,7,8,9,10,11,12]')
     p.add_option('--makemap', default=False, action = "store_true", help='Use this flag if you want to generate a map linking oligos to the ref seqs containing matching epitopes. Only the smallest kmers size provided is used to generate map [False]')
+    p.add_option('--binmap', default=False, action = "store_true", help='Use with --makemap to also write the map in a compact binary format (<out>_epitopemap.npz), holding the oligo and ref names and, for each oligo, the sorted ids of its matching refs. See read_binary_map() [False]')
 
     opts, args = p.parse_args()
     
     #Parse kmer sizes from input
     ksizes = [int(x) for x in opts.kmers.split(",")]
     
+    #Read both fasta files once, every kmer size is taken from the same scan of each
+    oligo_dict = read_fasta_dict_upper(opts.oligos)
+    ref_dict = read_fasta_dict_upper(opts.ref)
+    alphabet = residue_codes([oligo_dict, ref_dict])
+    design_scan = KmerScan(oligo_dict, alphabet)
+    ref_scan = KmerScan(ref_dict, alphabet)
+
     #Run some basic tests on designed oligos
-    oligo_dict_sets = basic_tests(opts)
+    basic_tests(oligo_dict, ref_scan)
     
-    print "kmerSize\tRef#\tDesign#\t#RefOnly\t#DesignOnly\t%RefOnly\t%DesignOnly\tAvgRedundancy\t%RefInDesign"
+    print("kmerSize\tRef#\tDesign#\t#RefOnly\t#DesignOnly\t%RefOnly\t%DesignOnly\tAvgRedundancy\t%RefInDesign")
     
-    for k in ksizes:
-        ref_k_dict = fasta2kmers(opts.ref, k)
-        design_k_dict = fasta2kmers(opts.oligos, k)
-        
-        total_ref_ks = combine_dicts(ref_k_dict.values())
-        total_design_ks = combine_dicts(design_k_dict.values())
+    table = {}
+    design_kmers = design_scan.kmers(ksizes)
+    for k, ref_ids, ref_seqs in ref_scan.kmers(ksizes):
+        k, design_ids, design_seqs = next(design_kmers)
         
-        ref_ks = set(total_ref_ks)
-        design_ks = set(total_design_ks)
+        ref_ks = sorted_unique(ref_ids)
+        design_ks = sorted_unique(design_ids)
+        num_total_design_ks = count_pairs(design_seqs, design_ids)
         
-        in_design_only = design_ks.difference(ref_ks)
-        in_ref_only = ref_ks.difference(design_ks)
-        print "%d\t%d\t%d\t%d\t%d\t%.3f%%\t%.3f%%\t%.3f\t%.3f%%" % (k, len(ref_ks), len(design_ks), len(in_ref_only), len(in_design_only), len(in_ref_only)/len(ref_ks)*100, len(in_design_only)/len(design_ks)*100, len(total_design_ks)/len(design_ks), len(design_ks)/len(ref_ks)*100)
-#        print "%d: %.2f%% in Ref only, %.2f%% in Design only" % (k, len(in_ref_only)/len(ref_k_dict)*100, len(in_design_only)/len(design_k_dict)*100)
+        num_shared = len(np.intersect1d(ref_ks, design_ks, assume_unique=True))
+        num_ref_only = len(ref_ks) - num_shared
+        num_design_only = len(design_ks) - num_shared
+        table[k] = "%d\t%d\t%d\t%d\t%d\t%.3f%%\t%.3f%%\t%.3f\t%.3f%%" % (k, len(ref_ks), len(design_ks), num_ref_only, num_design_only, num_ref_only/len(ref_ks)*100, num_design_only/len(design_ks)*100, num_total_design_ks/len(design_ks), len(design_ks)/len(ref_ks)*100)
+
+    for k in ksizes:
+        print(table[k])
         
         if opts.makemap and k == min(ksizes):
-            kmer_ref_dict = {}
-            for r, ks in ref_k_dict.iteritems():
-                for each in ks:
-                    if each not in kmer_ref_dict: kmer_ref_dict[each] = [r]
-                    else: kmer_ref_dict[each].append(r)
-            for d, ks in design_k_dict.iteritems():
-                for each in ks:
-                    oligo_dict_sets[d].update(kmer_ref_dict[each])
-
-            fout = open("%s_epitopemap.txt" % opts.out, "w")
-            for oname, rmatches in oligo_dict_sets.iteritems():
-                fout.write("%s\t%s\n" % (oname, "~".join(rmatches)))
+            kmer_index = kmer_ref_index(ref_scan, k)
+            map_ptr, map_refs = map_oligos(kmer_index, design_scan, k, len(ref_scan.names))
+            write_text_map("%s_epitopemap.txt" % opts.out, design_scan.names, ref_scan.names, map_ptr, map_refs)
+            if opts.binmap:
+                write_binary_map("%s_epitopemap.npz" % opts.out, design_scan.names, ref_scan.names, map_ptr, map_refs)
 
 #----------------------End of main()
 
-def basic_tests(opts):
-    oligo_dict = read_fasta_dict_upper(opts.oligos)
+def basic_tests(oligo_dict, ref_scan):
     # Check that all oligos are the same length
     oligo_lengths = [len(x) for x in oligo_dict.values()]
-    if len(set(oligo_lengths)) > 1: print "!!!!! Oligos are not all the same length. The following lengths were observed: %s" % (", ".join([str(x) for x in set(oligo_lengths)]))
+    if len(set(oligo_lengths)) > 1: print("!!!!! Oligos are not all the same length. The following lengths were observed: %s" % (", ".join([str(x) for x in set(oligo_lengths)])))
     else: 
 #        print "All oligos have %d amino acids" % (oligo_lengths[0])
         # Check that all oligos are present with the reference set of proteins
-        ref_y_dict = fasta2kmers(opts.ref, oligo_lengths[0])
+        k, ref_ids, ref_seqs = next(ref_scan.kmers([oligo_lengths[0]], keys=True))
 
-        total_ref_ys = combine_dicts(ref_y_dict.values())
-        total_design_ys = oligo_dict.values()
+        # The oligos as the same fixed width byte strings as the ref kmers
+        total_design_ys = np.array([x.encode("latin-1", "replace") for x in oligo_dict.values()], dtype="S%d" % k)
 
-        ref_ys = set(total_ref_ys)
-        design_ys = set(total_design_ys)
+        ref_ys = sorted_unique(ref_ids)
+        design_ys = sorted_unique(total_design_ys)
 
         # Check that all oligos are unique
-        if len(total_design_ys) != len(design_ys): print "!!!!! Out of %d oligos, only %d are unique" % (total_design_ys, design_ys)
+        if len(total_design_ys) != len(design_ys): print("!!!!! Out of %d oligos, only %d are unique" % (len(total_design_ys), len(design_ys)))
 
-        in_design_only = design_ys.difference(ref_ys)
-        in_ref_only = ref_ys.difference(design_ys)
+        num_shared = len(np.intersect1d(ref_ys, design_ys, assume_unique=True))
+        num_design_only = len(design_ys) - num_shared
+        num_ref_only = len(ref_ys) - num_shared
 
-        if in_design_only: print "!!!!!! There are %d oligos in the design that are not in the reference" % in_design_only
+        if num_design_only: print("!!!!!! There are %d oligos in the design that are not in the reference" % num_design_only)
 
-        print "OligoSize\tRef#\tDesign#\t#RefOnly\t#DesignOnly\t%RefOnly\t%DesignOnly\tAvgRedundancy\t%RefInDesign"
-        print "%d\t%d\t%d\t%d\t%d\t%.3f%%\t%.3f%%\t%.3f\t%.3f%%" % (oligo_lengths[0], len(ref_ys), len(design_ys), len(in_ref_only), len(in_design_only), len(in_ref_only)/len(ref_ys)*100, len(in_design_only)/len(design_ys)*100, len(total_design_ys)/len(design_ys), len(design_ys)/len(ref_ys)*100)
-    return {x:set([]) for x in oligo_dict}
+        print("OligoSize\tRef#\tDesign#\t#RefOnly\t#DesignOnly\t%RefOnly\t%DesignOnly\tAvgRedundancy\t%RefInDesign")
+        print("%d\t%d\t%d\t%d\t%d\t%.3f%%\t%.3f%%\t%.3f\t%.3f%%" % (oligo_lengths[0], len(ref_ys), len(design_ys), num_ref_only, num_design_only, num_ref_only/len(ref_ys)*100, num_design_only/len(design_ys)*100, len(total_design_ys)/len(design_ys), len(design_ys)/len(ref_ys)*100))
 
-def combine_dicts(list_of_dicts):
-    combolist = []
-    for l in list_of_dicts:
-        combolist+=l.keys()
-    return combolist
+# Kmers containing these characters are skipped
+SKIPPED = np.frombuffer(b"-X", dtype=np.uint8)
+
+def residue_codes(seq_dicts):
+    # Returns an array mapping each byte to a small code, numbering only the characters present in seq_dicts,
+    # along with the number of bits needed for each code
+    present = np.zeros(256, dtype=bool)
+    for seq_dict in seq_dicts:
+        for seq in seq_dict.values():
+            present[np.frombuffer(seq.encode("latin-1", "replace"), dtype=np.uint8)] = True
+    codes = np.zeros(256, dtype=np.uint64)
+    codes[present] = np.arange(present.sum())
+    return codes, max(1, int(present.sum()-1).bit_length())
+
+class KmerScan:
+    # The sequences of a fasta dict joined into one array, separated by '-' so no kmer spans two sequences.
+    # Kmers of every size are computed from this array in a single rolling scan
+    
+    def __init__(self, seq_dict, alphabet):
+        self.names = list(seq_dict)
+        self.codes, self.bits = alphabet
+        seqs = [seq_dict[n] for n in self.names]
+        self.raw = np.frombuffer("-".join(seqs).encode("latin-1", "replace"), dtype=np.uint8)
+        self.skipped = np.isin(self.raw, SKIPPED)
+        # Index of the sequence each position belongs to, separators included with the sequence before them
+        self.seq_index = np.repeat(np.arange(len(seqs)), [len(x)+1 for x in seqs])[:len(self.raw)]
+
+    def kmers(self, ksizes, keys=False):
+        # Yields (k, kmer ids, sequence index) for the kmers of each size in ksizes, skipping kmers with a '-' or 'X'.
+        # Ids are integers with self.bits bits per residue when they fit in 64 bits, and otherwise (or if keys is True)
+        # the kmers themselves as fixed width byte strings. Packed ids for each size are built from those of the size before
+        wanted = set(ksizes)
+        ids = np.zeros(len(self.raw), dtype=np.uint64)
+        skipped = np.zeros(len(self.raw), dtype=bool)
+        for k in range(1, max(ksizes)+1):
+            if k*self.bits <= 64 and not keys:
+                ids = (ids[:len(ids)-1] << np.uint64(self.bits)) | self.codes[self.raw[k-1:]] if k > 1 else self.codes[self.raw]
+            skipped = skipped[:len(skipped)-1] | self.skipped[k-1:] if k > 1 else self.skipped
+            
+            if k in wanted:
+                keep = ~skipped
+                if k > len(self.raw):
+                    yield k, np.zeros(0, dtype="S%d" % k), np.zeros(0, dtype=int)
+                elif k*self.bits <= 64 and not keys:
+                    yield k, ids[keep], self.seq_index[:len(keep)][keep]
+                else:
+                    windows = np.lib.stride_tricks.sliding_window_view(self.raw, k)[keep]
+                    yield k, np.ascontiguousarray(windows).view("S%d" % k).ravel(), self.seq_index[:len(keep)][keep]
+
+def count_pairs(seq_index, ids):
+    # Number of distinct (sequence, kmer) pairs, i.e., the total of the number of distinct kmers in each sequence
+    if len(ids) == 0:
+        return 0
+    order = np.lexsort((ids, seq_index))
+    seq_index = seq_index[order]
+    ids = ids[order]
+    return 1 + int(((seq_index[1:] != seq_index[:-1]) | (ids[1:] != ids[:-1])).sum())
 
+def first_of_runs(*arrays):
+    # Boolean mask of the positions in sorted arrays where a new run of equal values starts
+    first = np.zeros(len(arrays[0]), dtype=bool)
+    first[:1] = True
+    for a in arrays:
+        first[1:] |= a[1:] != a[:-1]
+    return first
+
+def sorted_unique(ids):
+    # Same as np.unique(ids), but always by sorting, which is much faster than the hash based path
+    # np.unique takes for integers in recent versions of NumPy
+    ids = np.sort(ids)
+    return ids[first_of_runs(ids)]
+
+def kmer_ref_index(ref_scan, k):
+    # CSR index from each distinct kmer of size k to the refs containing it.
+    # Returns the sorted kmer ids, the offsets of each kmer's entries and the ref ids, sorted within each kmer
+    k, ids, seq_index = next(ref_scan.kmers([k]))
+    order = np.lexsort((seq_index, ids))
+    ids = ids[order]
+    seq_index = seq_index[order]
+    
+    # Keep each (kmer, ref) pair once
+    keep = first_of_runs(ids, seq_index)
+    ids = ids[keep]
+    seq_index = seq_index[keep]
+    
+    starts = np.flatnonzero(first_of_runs(ids))
+    return ids[starts], np.append(starts, len(ids)), seq_index
+
+# Number of oligos whose ref matches are gathered at once in map_oligos
+MAP_BLOCK = 10000
+
+def map_oligos(kmer_index, design_scan, k, num_refs):
+    # Refs sharing at least one kmer of size k with each oligo, as CSR offsets per oligo into the ref ids.
+    # The ref ranges of all of an oligo's kmers are concatenated and reduced with sorted_unique, so each oligo's
+    # ref ids are sorted. Design kmers that are not in the refs match nothing
+    kmers, kmer_ptr, kmer_refs = kmer_index
+    k, ids, seq_index = next(design_scan.kmers([k]))
+    
+    pos = np.searchsorted(kmers, ids)
+    found = pos < len(kmers)
+    found[found] = kmers[pos[found]] == ids[found]
+    pos = pos[found]
+    seq_index = seq_index[found]
+    counts = kmer_ptr[pos+1] - kmer_ptr[pos]
+    
+    pairs = []
+    bounds = np.searchsorted(seq_index, np.arange(0, len(design_scan.names)+MAP_BLOCK, MAP_BLOCK))
+    for a, b in zip(bounds[:-1], bounds[1:]):
+        block_counts = counts[a:b]
+        within = np.arange(block_counts.sum()) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts)
+        refs = kmer_refs[np.repeat(kmer_ptr[pos[a:b]], block_counts) + within]
+        oligos = np.repeat(seq_index[a:b], block_counts).astype(np.int64)
+        pairs.append(sorted_unique(oligos*num_refs + refs))
+    pairs = np.concatenate(pairs) if pairs else np.zeros(0, dtype=np.int64)
+    
+    map_ptr = np.zeros(len(design_scan.names)+1, dtype=np.int64)
+    np.cumsum(np.bincount(pairs // num_refs, minlength=len(design_scan.names)), out=map_ptr[1:])
+    return map_ptr, pairs % num_refs
+
+def write_text_map(filename, oligo_names, ref_names, map_ptr, map_refs):
+    # One line per oligo: its name, then the names of its matching refs joined by '~'
+    with open(filename, "w") as fout:
+        for i, oname in enumerate(oligo_names):
+            fout.write("%s\t%s\n" % (oname, "~".join([ref_names[r] for r in map_refs[map_ptr[i]:map_ptr[i+1]]])))
+
+def write_binary_map(filename, oligo_names, ref_names, map_ptr, map_refs):
+    # Names are stored newline-joined as bytes, and the refs of oligo i are ref_ids[indptr[i]:indptr[i+1]].
+    # The number of refs is stored too, as an empty name list and a list of one empty name join to the same bytes
+    ref_dtype = np.uint32 if len(ref_names) <= np.iinfo(np.uint32).max else np.uint64
+    np.savez(filename, oligo_names=np.frombuffer("\n".join(oligo_names).encode(), dtype=np.uint8),
+             ref_names=np.frombuffer("\n".join(ref_names).encode(), dtype=np.uint8),
+             num_refs=len(ref_names), indptr=map_ptr, ref_ids=map_refs.astype(ref_dtype))
+
+def read_binary_map(filename):
+    # Returns the oligo names, ref names, per oligo offsets and ref ids written by write_binary_map()
+    with np.load(filename) as data:
+        # there is one oligo name per entry of indptr after the first
+        oligo_names = data["oligo_names"].tobytes().decode().split("\n") if len(data["indptr"]) > 1 else []
+        ref_names = data["ref_names"].tobytes().decode().split("\n") if data["num_refs"] > 0 else []
+        return oligo_names, ref_names, data["indptr"], data["ref_ids"]
 
 def combine_lists(list_of_lists):
     combolist = []
@@ -100,23 +236,6 @@ def combine_lists(list_of_lists):
         combolist+=l
     return combolist
 
-def fasta2kmers(fasta, kmersize):
-    kmer_dict = {}
-    fasta_dict = read_fasta_dict_upper(fasta)
-    for name, seq in fasta_dict.iteritems():
-        kmer_dict[name] = seq2kmers(seq, kmersize)
-    return kmer_dict
-
-def seq2kmers(seq, kmersize):
-    kmers={}
-    i=0
-    while i+kmersize <= len(seq):
-        k = seq[i:i+kmersize]
-        if not set(['-', 'X']).intersection(set([x for x in k])):
-            kmers[k] = ""
-        i+=1
-    return kmers
-
 def read_fasta_dict_upper(file):
     names, seqs = read_fasta_lists(file)
     seqs = [x.upper() for x in seqs]
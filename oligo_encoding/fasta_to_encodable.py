@@ -17,6 +17,11 @@ def main():
                            )
     arg_parser.add_argument( '-p', '--prefix', help = "Prefix for names that will be written to the encoded format. " )
     arg_parser.add_argument( '-m', '--map_file', help = "File to write tab-delimited pairings of original name to prefix name and number." )
+    arg_parser.add_argument( '--stream', action = 'store_true', help = "Write the output and map file in a single pass over the input, "
+                                                                       "without holding the library in memory. Every record is "
+                                                                       "written, so names that appear more than once in the input "
+                                                                       "are not collapsed into a single entry."
+                           )
 
     args = arg_parser.parse_args()
 
@@ -27,6 +32,10 @@ def main():
         output = input_file + '_encodable.csv'
     line_width = args.line_size
 
+    if args.stream:
+        stream_output( input_file, output, args.map_file, args.prefix, line_width )
+        return
+
     original_names_and_seqs = fasta_to_dict( input_file )
     prefixed_names          = gen_prefixed_names( original_names_and_seqs.keys(), args.prefix )
 
@@ -35,6 +44,51 @@ def main():
     prefixed_names_and_seqs = set_prefixed_names_to_seqs( original_names_and_seqs, prefixed_names )
     write_output( args.output, prefixed_names_and_seqs, args.line_size )
 
+def stream_output( input_file, filename, map_filename, prefix, line_size ):
+    """
+       Writes the encodable output and the map file together, one record at a
+       time. The width of the numbers in the prefixed names is taken from a
+       count of the records made before writing.
+    """
+    num_digits = int( math.log10( count_records( input_file ) ) + 1 )
+
+    with open( filename, 'w' ) as open_file, open( map_filename, 'w' ) as map_file:
+        for index, ( name, seq ) in enumerate( iter_fasta( input_file ) ):
+            prefixed_name = "%s_%s" % ( prefix, str( index ).zfill( num_digits ) )
+            map_file.write( "%s\t%s\n" % ( name, prefixed_name ) )
+
+            if len( prefixed_name ) + len( seq ) + 2 >= line_size:
+                print( "WARNING: %s,%s is too long of a line!" % ( prefixed_name, seq ) )
+            open_file.write( "%s,%s\n" % ( prefixed_name, seq ) )
+
+def count_records( filename ):
+    with open( filename, 'rb' ) as open_file:
+        return sum( 1 for line in open_file if line.startswith( b'>' ) )
+
+def iter_fasta( filename ):
+    """
+       Reads a fasta file one record at a time
+
+       Yields:
+        ( name, sequence ) for each record in the file
+    """
+    name = None
+    current_sequence = list()
+
+    with open( filename, 'r' ) as open_file:
+        for line in open_file:
+            line = line.strip()
+            if line and line[ 0 ] == '>':
+                if name is not None:
+                    yield name, ''.join( current_sequence )
+                name = line[ 1: ]
+                current_sequence = list()
+            else:
+                current_sequence.append( line )
+
+    if name is not None:
+        yield name, ''.join( current_sequence )
+
 def write_output( filename, names_dict, line_size ):
     with open( filename, 'w' ) as open_file:
         for name, seq in names_dict.items():
@@ -2,10 +2,17 @@
 import h2o        # For running models
 import argparse   # for parsing command-line args
 import pandas     # reading csv
-import io         # for encoding strings as files
+import numpy      # for the in-process codon sampler
+import multiprocessing as mp
 import subprocess # for calling the oligo encoding script
+import os
+import signal     # for stopping the sampler when the pipeline fails
+import queue      # for passing chunks between pipeline stages
+import io         # for parsing chunks of lines read from the seq and ratio files
+import itertools
+import tempfile
+import threading
 from timeit import default_timer as timer
-import multiprocessing as mp
 
 def main():
     arg_parser = argparse.ArgumentParser( description = "Use h2o to select encodings for oligos." )  
@@ -41,11 +48,62 @@ def main():
     arg_parser.add_argument( '--read_per_loop', type = int, default = 10, help = "Number of lines from the output seq and ratio files to read at a time, "
                                                                                  "the higher this parameter is the more memory will be used by h2o."
                            )
+    arg_parser.add_argument( '--memory_budget', type = float, help = "Approximate memory, in MB, to use for each chunk read from the seq and "
+                                                                     "ratio files. If provided, the number of sequences read at a time is "
+                                                                     "chosen from this budget and --read_per_loop is ignored."
+                           )
+    arg_parser.add_argument( '--pipeline', action = 'store_true', help = "Overlap reading, prediction and selection. Chunk i is predicted while "
+                                                                         "chunk i+1 is read and chunk i-1 is selected and written. If --input is "
+                                                                         "provided, the output of the oligo_encoding script is read as it is "
+                                                                         "produced, and the seq and ratio files are not written."
+                           )
+    arg_parser.add_argument( '--queue_size', type = int, default = 2, help = "Maximum number of chunks waiting between each pipeline stage with "
+                                                                             "--pipeline. Up to about three times this many chunks may be held in memory."
+                           )
+    arg_parser.add_argument( '--sampler', default = 'main', choices = [ 'main', 'python' ],
+                             help = "Codon sampler used to generate encodings from --input. 'main' runs the compiled oligo_encoding "
+                                    "script, which writes the seq and ratio files. 'python' samples all trials for a peptide at "
+                                    "once with NumPy, in --cores processes, and passes the encodings straight to prediction "
+                                    "without writing the seq and ratio files."
+                           )
+    arg_parser.add_argument( '--seed', type = int, help = "Random seed for '--sampler python'" )
+    arg_parser.add_argument( '--mojo', help = "(Optional) MOJO export of the model. If provided, predictions are made locally with "
+                                              "the h2o genmodel jar instead of through an h2o cluster, and --model is not used."
+                           )
+    arg_parser.add_argument( '--genmodel_jar', help = "Path to h2o-genmodel.jar for --mojo. By default the jar bundled with the h2o "
+                                                      "python module is used."
+                           )
+    arg_parser.add_argument( '--batch_seconds', type = float, default = 5, help = "Target time, in seconds, for scoring each batch "
+                                                                                "uploaded to h2o. Batch sizes are adjusted to this from "
+                                                                                "the measured scoring rate, up to one chunk, and are also "
+                                                                                "kept within --memory_budget (or %d MB if it is not given), "
+                                                                                "from the measured size of each row." % DEFAULT_BATCH_MEMORY
+                           )
+    arg_parser.add_argument( '--resume', action = 'store_true', help = "Continue an interrupted run from the last chunk recorded in "
+                                                                       "{out_file}.progress. Requires the seq and ratio files, so "
+                                                                       "cannot be combined with '--sampler python' or with --pipeline "
+                                                                       "and --input."
+                           )
     arg_parser.add_argument( '--adapter', type = str, default = "CCTATACTTCCAAGGCGCA|GGTGACTCTCTGTCTTGGC", help = "Adapter to add to output encoded sequences. In the form {prefix}|{suffix}" )
 
     args = arg_parser.parse_args()
 
-    if args.input:
+    if args.resume and args.input and ( args.pipeline or args.sampler == 'python' ):
+        arg_parser.error( "--resume requires the seq and ratio files to be written, so it cannot be used with "
+                          "'--sampler python', or with --pipeline and --input."
+                        )
+
+    ledger = ProgressLedger( args.out_file + '.progress', args.sequences, args.ratio_file )
+    progress = None
+    if args.resume:
+        progress = ledger.load()
+        if progress is None:
+            print( "WARNING: No progress was recorded for %s, starting from the beginning." % args.out_file )
+    if progress is None:
+        # progress left by an earlier run does not apply to the files this run writes
+        ledger.clear()
+
+    if args.input and not args.pipeline and args.sampler == 'main' and progress is None:
         generate_oligos( args )
     if ( not args.input ) and args.subsample:
         print( "WARNING: Input file was not provided, but subsample argument was. "
@@ -54,123 +112,640 @@ def main():
                "is set to however many encodings were generated for each sequences."
              )
 
-    h2o.init()
-
-    loaded_model = h2o.load_model( args.model )
-
-    best_encodings           = pandas.DataFrame()
-
-    generated_sequences = open( args.sequences,  'r' )
-    ratio_file          = open( args.ratio_file, 'r' )
-    out_file            = open( args.out_file,   'w' )
-
-    num_to_read   = args.read_per_loop
-    current_seq   = read_seq( generated_sequences,    args.subsample, num_to_read )
-    current_ratio = read_and_label_ratio( ratio_file, args.subsample, num_to_read )
-
-    while not current_seq is None and not current_ratio is None:
-        predictions = loaded_model.predict( h2o.H2OFrame( current_ratio ) )
-
-        current_seq[ 'predicted' ]     = predictions.as_data_frame()
-        current_seq[ 'predicted_dev' ] = predictions.abs().as_data_frame()
-
-        best_encodings = get_n_best_encodings( current_seq, 'AA Peptide', args.nn_subset_size, args.cores )
-
-        best_encodings[ "Nucleotide Encoding w/ Adapters" ] = add_adapters( best_encodings[ "Nucleotide Encoding" ], args.adapter )
-
-        write_output( best_encodings, out_file )
-
-        current_seq   = read_seq( generated_sequences,    args.subsample, num_to_read )
-        current_ratio = read_and_label_ratio( ratio_file, args.subsample, num_to_read )
+    sampling = None
+    if args.input and args.sampler == 'python':
+        # forked before h2o or the pipeline start any threads
+        sampling = start_codon_sampler( args )
+
+    if args.mojo:
+        scorer = MojoScorer( args.mojo, args.genmodel_jar )
+    else:
+        h2o.init()
+        scorer = H2OScorer( args.model, args.batch_seconds, args.memory_budget )
+
+    offsets      = ( 0, 0 )
+    rows_written = 0
+    if progress:
+        # drop anything written after the last recorded chunk, so no rows are duplicated
+        with open( args.out_file, 'r+' ) as open_file:
+            open_file.truncate( progress[ 'out_offset' ] )
+        out_file     = open( args.out_file, 'a' )
+        offsets      = ( progress[ 'seq_offset' ], progress[ 'ratio_offset' ] )
+        rows_written = progress[ 'rows_written' ]
+        print( "Resuming after %d encodings written to %s." % ( rows_written, args.out_file ) )
+    else:
+        out_file = open( args.out_file, 'w' )
+
+    chunk_size = get_chunk_size( args )
+
+    if args.pipeline:
+        run_pipeline( args, scorer, out_file, chunk_size, ledger, offsets, rows_written, sampling )
+    else:
+        if args.input and args.sampler == 'python':
+            chunks = ( ( seqs, ratios, None ) for seqs, ratios in sample_chunks( args, chunk_size, sampling ) )
+        else:
+            chunks = read_chunks( args.sequences, args.ratio_file, chunk_size, offsets )
+
+        for current_seq, current_ratio, chunk_offsets in chunks:
+            predict_chunk( scorer, current_seq, current_ratio )
+            rows_written += select_and_write( current_seq, args, out_file )
+            if chunk_offsets:
+                ledger.record( out_file, chunk_offsets, rows_written )
+
+    out_file.close()
+    ledger.clear()
+
+class ProgressLedger:
+    """
+       Records, after each chunk has been written, how far the seq and ratio
+       files have been read and how much has been written to the output file,
+       so that an interrupted run can continue with --resume
+    """
+    def __init__( self, filename, sequences, ratio_file ):
+        self.filename   = filename
+        self.sequences  = sequences
+        self.ratio_file = ratio_file
+
+    def record( self, out_file, offsets, rows_written ):
+        # the output must be on disk before the ledger says it is
+        out_file.flush()
+        os.fsync( out_file.fileno() )
+
+        with open( self.filename + '.tmp', 'w' ) as open_file:
+            open_file.write( "sequences\t%s\n" % self.sequences )
+            open_file.write( "ratio_file\t%s\n" % self.ratio_file )
+            open_file.write( "seq_offset\t%d\n" % offsets[ 0 ] )
+            open_file.write( "ratio_offset\t%d\n" % offsets[ 1 ] )
+            open_file.write( "rows_written\t%d\n" % rows_written )
+            open_file.write( "out_offset\t%d\n" % out_file.tell() )
+        os.replace( self.filename + '.tmp', self.filename )
+
+    def clear( self ):
+        for filename in [ self.filename, self.filename + '.tmp' ]:
+            if os.path.exists( filename ):
+                os.remove( filename )
+
+    def load( self ):
+        """
+           Returns the recorded progress as a dict, or None if nothing has been recorded
+        """
+        if not os.path.exists( self.filename ):
+            return None
+
+        progress = {}
+        with open( self.filename, 'r' ) as open_file:
+            for line in open_file:
+                key, value = line.rstrip( '\n' ).split( '\t', 1 )
+                progress[ key ] = value
+
+        if progress[ 'sequences' ] != self.sequences or progress[ 'ratio_file' ] != self.ratio_file:
+            raise ValueError( "%s was recorded for %s and %s, not the files provided."
+                              % ( self.filename, progress[ 'sequences' ], progress[ 'ratio_file' ] )
+                            )
+        for key in [ 'seq_offset', 'ratio_offset', 'rows_written', 'out_offset' ]:
+            progress[ key ] = int( progress[ key ] )
+        return progress
+
+def predict_chunk( scorer, current_seq, current_ratio ):
+    predicted = scorer.predict( current_ratio )
+
+    current_seq[ 'predicted' ]     = predicted
+    current_seq[ 'predicted_dev' ] = numpy.abs( predicted )
+
+# Bounds on the number of rows uploaded to h2o at a time
+MIN_BATCH_SIZE     = 1000
+INITIAL_BATCH_SIZE = 10000
+
+# Memory, in MB, that a batch uploaded to h2o may use when no --memory_budget is given
+DEFAULT_BATCH_MEMORY = 512
+
+class H2OScorer:
+    """
+       Scores ratio frames with a model loaded once into the running h2o
+       session. Each frame is uploaded in batches, sized from the scoring rate
+       measured on earlier batches so each takes about target_seconds, and
+       removed from the cluster once its predictions have been pulled back.
+       Batches are also kept to memory_budget MB, from the measured size of
+       each row of the frame.
+    """
+    def __init__( self, model_path, target_seconds = 5, memory_budget = None ):
+        self.model          = h2o.load_model( model_path )
+        self.target_seconds = target_seconds
+        self.memory_budget  = memory_budget or DEFAULT_BATCH_MEMORY
+        self.batch_size     = INITIAL_BATCH_SIZE
+        self.max_batch_size = None
+
+    def predict( self, ratio_frame ):
+        predicted = list()
+        start = 0
+
+        if len( ratio_frame ):
+            row_bytes = ratio_frame.memory_usage( index = False, deep = True ).sum() / len( ratio_frame )
+            self.max_batch_size = max( int( self.memory_budget * 1024 * 1024 // max( row_bytes, 1 ) ), MIN_BATCH_SIZE )
+            self.batch_size     = min( self.batch_size, self.max_batch_size )
+
+        while start < len( ratio_frame ):
+            batch = ratio_frame.iloc[ start:start + self.batch_size ]
+
+            batch_start = timer()
+            h2o_frame   = h2o.H2OFrame( batch )
+            predictions = self.model.predict( h2o_frame )
+            predicted.append( predictions.as_data_frame().iloc[ :, 0 ].to_numpy() )
+            h2o.remove( [ h2o_frame, predictions ] )
+
+            self.adjust_batch_size( len( batch ), timer() - batch_start )
+            start += len( batch )
+
+        if not predicted:
+            return numpy.array( [] )
+        return numpy.concatenate( predicted )
+
+    def adjust_batch_size( self, rows, elapsed ):
+        # grow at most twofold per batch, so one fast batch cannot overshoot
+        rate = rows / max( elapsed, 1e-6 )
+        new_size = min( int( rate * self.target_seconds ), 2 * max( rows, self.batch_size ) )
+        if self.max_batch_size:
+            new_size = min( new_size, self.max_batch_size )
+        self.batch_size = max( new_size, MIN_BATCH_SIZE )
+
+class MojoScorer:
+    """
+       Scores ratio frames locally with a MOJO export of the model, without
+       an h2o cluster
+    """
+    def __init__( self, mojo_path, genmodel_jar = None ):
+        self.mojo_path    = mojo_path
+        self.genmodel_jar = genmodel_jar
+
+    def predict( self, ratio_frame ):
+        predictions = h2o.mojo_predict_pandas( ratio_frame, self.mojo_path, genmodel_jar_path = self.genmodel_jar )
+        return predictions.iloc[ :, 0 ].to_numpy()
+
+def select_and_write( current_seq, args, out_file ):
+    best_encodings = get_n_best_encodings( current_seq, 'AA Peptide', args.nn_subset_size )
+
+    best_encodings[ "Nucleotide Encoding w/ Adapters" ] = add_adapters( best_encodings[ "Nucleotide Encoding" ], args.adapter )
+
+    write_output( best_encodings, out_file )
+    return len( best_encodings )
+
+def sampler_command( args, seq_file, ratio_file ):
+    return ( "./main -i %s -s %s -r %s -p %s -n %d -g %f -t %d -c %d" %
+             ( args.input, seq_file, ratio_file, args.probability_file, args.subsample, args.gc_target, args.trials, args.cores )
+           )
 
 def generate_oligos( args ):
-    subprocess.call( "./main -i %s -s %s -r %s -p %s -n %d -g %f -t %d -c %d" %
-                     ( args.input, args.sequences, args.ratio_file, args.probability_file, args.subsample, args.gc_target, args.trials, args.cores ),
+    subprocess.call( sampler_command( args, args.sequences, args.ratio_file ),
                      shell = True
                    )
-def read_seq( open_file, subsample, num_to_read ):
-    io_data = read_n_lines_from_file( open_file, num_to_read * subsample )
-
-    if io_data:
-        return read_seq_file( io_data )
-    return None
-
-def read_and_label_ratio( open_file, subsample, num_to_read ):
-    io_data = read_n_lines_from_file( open_file, num_to_read * subsample )
-    if io_data:
-        return read_ratio_and_label( io_data )
-    return None
-
-def read_n_lines_from_file( open_file, n ):
-    seq_str = ""
-    for cur in range( n ):
-        seq_str += open_file.readline()
-    if seq_str:
-        return io.StringIO( seq_str )
-    return None
-    
+
+def fill_queue( chunks, *out_queues, stop = None ):
+    """
+       Puts every item of chunks on the queue, followed by None. With several
+       queues, each item is a tuple holding one part for each queue. An exception
+       raised while reading is put on the queues for the consumer to re-raise.
+       Stops early once the stop event, if given, is set.
+    """
+    try:
+        for chunk in chunks:
+            if stop is not None and stop.is_set():
+                break
+            parts = chunk if len( out_queues ) > 1 else ( chunk, )
+            for out_queue, part in zip( out_queues, parts ):
+                out_queue.put( part )
+    except Exception as error:
+        for out_queue in out_queues:
+            out_queue.put( error )
+    for out_queue in out_queues:
+        out_queue.put( None )
+
+def get_from_queue( in_queue ):
+    item = in_queue.get()
+    if isinstance( item, Exception ):
+        raise item
+    return item
+
+def drain_queue( in_queue ):
+    while in_queue.get() is not None:
+        pass
+
+def open_fifos( fifos ):
+    """
+       Opens the read end of each fifo, then a write end held by this process,
+       before the sampler starts. Readers then cannot block opening a fifo the
+       sampler never opens, or see end of file before the sampler has opened it.
+
+       Returns:
+        ( read fds, write fds ), one of each per fifo
+    """
+    read_fds  = list()
+    write_fds = list()
+    for fifo in fifos:
+        # a non-blocking open returns at once without a writer, then reads block as usual
+        fd = os.open( fifo, os.O_RDONLY | os.O_NONBLOCK )
+        os.set_blocking( fd, True )
+        read_fds.append( fd )
+        write_fds.append( os.open( fifo, os.O_WRONLY ) )
+    return read_fds, write_fds
+
+def release_fifos( sampler, write_fds ):
+    """
+       Waits for the sampler to exit, then closes the write ends held by
+       open_fifos, so the readers see end of file once the sampler's output
+       has been read, whether or not the sampler ever opened the fifos
+    """
+    sampler.wait()
+    for fd in write_fds:
+        os.close( fd )
+
+def run_pipeline( args, scorer, out_file, chunk_size, ledger, offsets = ( 0, 0 ), rows_written = 0, sampling = None ):
+    """
+       Runs reading, prediction and selection as concurrent stages joined by
+       queues of at most args.queue_size chunks. The seq and ratio files are
+       read by separate threads, because the oligo_encoding script writes
+       them alternately and would block if either one were left unread.
+       Progress is recorded in ledger when reading from the seq and ratio files.
+       sampling is passed on to sample_chunks with '--sampler python'.
+    """
+    seq_queue     = queue.Queue( args.queue_size )
+    ratio_queue   = queue.Queue( args.queue_size )
+    predict_queue = queue.Queue( args.queue_size )
+
+    seq_file, ratio_file = args.sequences, args.ratio_file
+    seq_source, ratio_source = seq_file, ratio_file
+    work_dir = None
+    sampler  = None
+    threads  = list()
+    stop     = threading.Event()
+
+    if args.input and args.sampler == 'python':
+        threads.append( threading.Thread( target = fill_queue,
+                                          args = ( ( ( ( seqs, None ), ( ratios, None ) ) for seqs, ratios in sample_chunks( args, chunk_size, sampling ) ),
+                                                   seq_queue, ratio_queue
+                                                 ),
+                                          kwargs = { 'stop': stop }
+                                        )
+                      )
+    elif args.input:
+        work_dir   = tempfile.mkdtemp()
+        seq_file   = os.path.join( work_dir, 'seqs.csv' )
+        ratio_file = os.path.join( work_dir, 'ratios.csv' )
+        os.mkfifo( seq_file )
+        os.mkfifo( ratio_file )
+        offsets = ( None, None )
+        ( seq_source, ratio_source ), write_fds = open_fifos( [ seq_file, ratio_file ] )
+
+        # in its own session, so the shell and the sampler it starts can be stopped together
+        sampler = subprocess.Popen( sampler_command( args, seq_file, ratio_file ), shell = True, start_new_session = True )
+        threads.append( threading.Thread( target = release_fifos, args = ( sampler, write_fds ) ) )
+
+    if not ( args.input and args.sampler == 'python' ):
+        threads.append( threading.Thread( target = fill_queue,
+                                          args = ( read_line_chunks( seq_source, SEQ_COLUMNS, chunk_size, offsets[ 0 ] ), seq_queue ),
+                                          kwargs = { 'stop': stop }
+                                        )
+                      )
+        threads.append( threading.Thread( target = fill_queue,
+                                          args = ( read_line_chunks( ratio_source, RATIO_COLUMNS, chunk_size, offsets[ 1 ] ), ratio_queue ),
+                                          kwargs = { 'stop': stop }
+                                        )
+                      )
+
+    write_errors = list()
+    def write_stage():
+        written = rows_written
+        try:
+            item = get_from_queue( predict_queue )
+            while item is not None:
+                current_seq, chunk_offsets = item
+                written += select_and_write( current_seq, args, out_file )
+                if chunk_offsets[ 0 ] is not None:
+                    ledger.record( out_file, chunk_offsets, written )
+                item = get_from_queue( predict_queue )
+        except Exception as error:
+            write_errors.append( error )
+            drain_queue( predict_queue )
+
+    finished = set()
+    def next_chunk( in_queue ):
+        item = get_from_queue( in_queue )
+        if item is None:
+            finished.add( in_queue )
+        return item
+
+    threads.append( threading.Thread( target = write_stage ) )
+
+    for thread in threads:
+        thread.start()
+
+    completed = False
+    try:
+        current_seq   = next_chunk( seq_queue )
+        current_ratio = next_chunk( ratio_queue )
+
+        while current_seq is not None and current_ratio is not None and not write_errors:
+            ( seq_frame, seq_offset ), ( ratio_frame, ratio_offset ) = current_seq, current_ratio
+            predict_chunk( scorer, seq_frame, ratio_frame )
+            predict_queue.put( ( seq_frame, ( seq_offset, ratio_offset ) ) )
+
+            current_seq   = next_chunk( seq_queue )
+            current_ratio = next_chunk( ratio_queue )
+        completed = not write_errors
+    finally:
+        predict_queue.put( None )
+
+        if not completed:
+            # report the error now, rather than after the rest of the library has been sampled and read.
+            # Once the sampler is gone, release_fifos lets any reader still waiting on a fifo see end of file
+            stop.set()
+            if sampler and sampler.poll() is None:
+                try:
+                    os.killpg( sampler.pid, signal.SIGTERM )
+                except ProcessLookupError:
+                    pass
+
+        # let the readers reach the end of their files, so every thread can exit
+        for in_queue in [ seq_queue, ratio_queue ]:
+            if in_queue not in finished:
+                drain_queue( in_queue )
+        for thread in threads:
+            thread.join()
+
+        if work_dir:
+            os.remove( seq_file )
+            os.remove( ratio_file )
+            os.rmdir( work_dir )
+
+    if write_errors:
+        raise write_errors[ 0 ]
+    if sampler and sampler.returncode != 0:
+        raise RuntimeError( "oligo_encoding script exited with status %d" % sampler.returncode )
+
+# Rough ratio of the memory used by a parsed row, including its h2o copy, to the row's size on disk
+PARSED_ROW_FACTOR = 4
+
+# Approximate size on disk of one row of 88 ratios written by the oligo_encoding script
+RATIO_ROW_BYTES = 88 * 7
+
+def get_chunk_size( args ):
+    """
+       Number of rows to read from the seq and ratio files at a time. Always a
+       multiple of subsample, so every peptide's encodings are in the same chunk.
+    """
+    if not args.memory_budget:
+        return args.read_per_loop * args.subsample
+
+    row_bytes = 0
+    if args.input and ( args.pipeline or args.sampler == 'python' ):
+        # the seq and ratio files are not available to measure, so estimate them from
+        # the input: the seq row holds the name, peptide and 3x longer encoding
+        with open( args.input, 'r' ) as open_file:
+            row_bytes = 4 * len( open_file.readline() ) + RATIO_ROW_BYTES
+    else:
+        for filename in [ args.sequences, args.ratio_file ]:
+            with open( filename, 'r' ) as open_file:
+                row_bytes += len( open_file.readline() )
+    row_bytes = max( row_bytes, 1 ) * PARSED_ROW_FACTOR
+
+    num_peptides = int( args.memory_budget * 1024 * 1024 // ( row_bytes * args.subsample ) )
+    return max( num_peptides, 1 ) * args.subsample
+
+def read_chunks( seq_filename, ratio_filename, chunk_size, offsets = ( 0, 0 ) ):
+    """
+       Reads the seq and ratio files produced by the oligo_encoding script in
+       lockstep, chunk_size rows at a time, starting from the given byte offsets
+
+       Yields:
+        ( seq_dataframe, ratio_dataframe, ( seq_offset, ratio_offset ) ) for each
+        chunk, with both frames indexed from 0 and the offsets of the end of the chunk
+    """
+    seq_reader   = read_line_chunks( seq_filename, SEQ_COLUMNS, chunk_size, offsets[ 0 ] )
+    ratio_reader = read_line_chunks( ratio_filename, RATIO_COLUMNS, chunk_size, offsets[ 1 ] )
+
+    for ( seq_chunk, seq_offset ), ( ratio_chunk, ratio_offset ) in zip( seq_reader, ratio_reader ):
+        yield seq_chunk, ratio_chunk, ( seq_offset, ratio_offset )
+
+def read_line_chunks( filename, columns, chunk_size, offset = 0 ):
+    """
+       Reads a headerless csv chunk_size lines at a time, starting at byte offset.
+       Each chunk is parsed as soon as its lines are available, so this also
+       works on fifos that are still being written to (offset None). filename
+       may also be an open file descriptor, which is closed when reading ends.
+
+       Yields:
+        ( dataframe, offset ) for each chunk, where offset is the byte offset of
+        the end of the chunk, or None for a fifo
+    """
+    with open( filename, 'rb' ) as open_file:
+        if offset:
+            open_file.seek( offset )
+
+        lines = b''.join( itertools.islice( open_file, chunk_size ) )
+        while lines:
+            if offset is not None:
+                offset += len( lines )
+            yield pandas.read_csv( io.BytesIO( lines ), header = None, names = columns ), offset
+            lines = b''.join( itertools.islice( open_file, chunk_size ) )
+
 def write_output( encodings, outfile ):
     encodings.to_csv( outfile, index = False,
                       header = outfile.tell() == 0
                     )
 
 
-def get_n_best_encodings( seqs_dataframe, key, n, cores ):
-    pool = mp.Pool( cores - 1 )
-    args = list()
+def get_n_best_encodings( seqs_dataframe, key, n ):
+    """
+       Selects, for each unique value of key, the n distinct nucleotide encodings
+       with the smallest predicted deviation. Peptides are output in the order
+       they first appear in seqs_dataframe.
+    """
+    start = timer()
 
-    unique_seqs = get_unique_seqs( seqs_dataframe, key )
-    for index, seq in enumerate( unique_seqs ):
-        args.append( ( seqs_dataframe, 'AA Peptide', n, seq ) )
+    unique_seqs = seqs_dataframe.drop_duplicates( subset = [ key, 'Nucleotide Encoding' ] )
+    order       = unique_seqs.groupby( key, sort = False ).ngroup()
 
-    start = timer()
-    result = pool.map( get_n_best_encodings_parr,
-                       args
-    )
+    sorted_data = unique_seqs.assign( peptide_order = order ).sort_values( [ 'peptide_order', 'predicted_dev' ],
+                                                                           kind = 'mergesort'
+                                                                         )
+    results_df  = sorted_data.groupby( 'peptide_order', sort = False ).head( n ).drop( columns = 'peptide_order' )
 
-    pool.close()
-    pool.join()
-    results_df = pandas.concat( result )
     end = timer()
 
     print( "Time to generate results: %f" % ( end - start ) )
     return results_df 
 
-def get_n_best_encodings_parr( arg ):
-    seqs_dataframe = arg[ 0 ]
-    key            = arg[ 1 ]
-    n              = arg[ 2 ]
-    seq_id         = arg[ 3 ]
-    total_start = timer()
-    out_frame = pandas.DataFrame()
-
-    desired = seqs_dataframe[ key ] == seq_id 
-    relevant_data = seqs_dataframe[ desired ]
-    unique_seqs = relevant_data.drop_duplicates( subset = 'Nucleotide Encoding' )
-    print( len( unique_seqs ) )
-    sorted_data   = unique_seqs.sort_values( 'predicted_dev' )
-    out_frame     = out_frame.append( sorted_data.iloc[ 0:n ] )
-
-    total_end = timer()
-
-    return out_frame
-
-def get_unique_seqs( dataframe, key ):
-    return set( dataframe[ key ] )
-def read_ratio_and_label( filename ):
-    parsed_file = pandas.read_csv( filename )
-
-    parsed_file.columns = [ "C" + str( item ) for item in range( 1442,1530 ) ]
-
-    return parsed_file
-
-def read_seq_file( filename ):
-    parsed_file = pandas.read_csv( filename )
-    parsed_file.columns = [ "Seq ID", "AA Peptide", "Nucleotide Encoding",
-                            "GC Ratio", "GC Dev (abs)"
-                          ]
-
-    return parsed_file
+SEQ_COLUMNS   = [ "Seq ID", "AA Peptide", "Nucleotide Encoding", "GC Ratio", "GC Dev (abs)" ]
+RATIO_COLUMNS = [ "C" + str( item ) for item in range( 1442,1530 ) ]
+
+AMINO_ACIDS     = "ACDEFGHIKLMNPQRSTVWY"
+AMBIGUOUS_CODES = set( "BZUOJ" )
+
+class CodonSampler:
+    """
+       In-process version of the oligo_encoding script (main.cpp). For each
+       peptide, codons for every trial are drawn at once from the weights in
+       the probability file, and the subsample encodings with GC ratio closest
+       to gc_target are kept along with their 88 ratio features.
+    """
+    def __init__( self, probability_file, trials, subsample, gc_target ):
+        self.trials    = trials
+        self.subsample = min( subsample, trials )
+        self.gc_target = gc_target
+        self.digits    = len( str( trials ) )
+
+        table = {}
+        with open( probability_file, 'r' ) as open_file:
+            for line in open_file:
+                if line.strip():
+                    aa, codon, weight, index = line.strip().split( ',' )
+                    table.setdefault( aa, list() ).append( ( codon, float( weight ), int( index ) ) )
+
+        max_codons = max( len( codons ) for codons in table.values() )
+        self.aa_index = { aa: index for index, aa in enumerate( sorted( table ) ) }
+
+        # padded entries have a cumulative weight above 1, so they are never drawn
+        self.cumulative  = numpy.full( ( len( table ), max_codons ), 2.0 )
+        self.codon_index = numpy.zeros( ( len( table ), max_codons ), dtype = numpy.int64 )
+        self.codon_bytes = numpy.zeros( ( len( table ), max_codons, 3 ), dtype = numpy.uint8 )
+        self.nucleotides = numpy.zeros( ( len( table ), max_codons, 4 ) )
+
+        for aa, codons in table.items():
+            row     = self.aa_index[ aa ]
+            weights = numpy.array( [ weight for _, weight, _ in codons ] )
+            cumulative = numpy.cumsum( weights / weights.sum() )
+            cumulative[ -1 ] = 1.0
+
+            self.cumulative[ row, :len( codons ) ] = cumulative
+            for position, ( codon, _, index ) in enumerate( codons ):
+                self.codon_index[ row, position ] = index
+                self.codon_bytes[ row, position ] = numpy.frombuffer( codon.encode(), dtype = numpy.uint8 )
+                self.nucleotides[ row, position ] = [ codon.count( nuc ) for nuc in "ACGT" ]
+
+    def sample( self, name, peptide, rng ):
+        """
+           Returns:
+            ( seq_dataframe, ratio_dataframe ) for the best subsample encodings,
+            in the same layout as the seq and ratio files written by main.cpp
+        """
+        positions = numpy.array( [ self.aa_index[ aa ] for aa in peptide ] )
+        length    = len( peptide )
+
+        draws  = rng.random( ( self.trials, length ) )
+        choice = ( draws[ :, :, None ] > self.cumulative[ positions ][ None, :, : ] ).sum( axis = 2 )
+
+        nucleotides = self.nucleotides[ positions, choice ].sum( axis = 1 )
+        gc_ratio    = ( nucleotides[ :, 1 ] + nucleotides[ :, 2 ] ) / nucleotides.sum( axis = 1 )
+        gc_dev      = numpy.abs( gc_ratio - self.gc_target )
+
+        best = numpy.arange( self.trials )
+        if self.subsample < self.trials:
+            best = numpy.argpartition( gc_dev, self.subsample - 1 )[ :self.subsample ]
+        best   = best[ numpy.argsort( gc_dev[ best ], kind = 'stable' ) ]
+        choice = choice[ best ]
+
+        encodings = self.codon_bytes[ positions, choice ].reshape( len( best ), 3 * length )
+        encodings = encodings.view( 'S%d' % ( 3 * length ) ).ravel().astype( str )
+
+        seq_frame = pandas.DataFrame( { "Seq ID": [ "%s_%0*d" % ( name, self.digits, index + 1 ) for index in range( len( best ) ) ],
+                                        "AA Peptide": peptide,
+                                        "Nucleotide Encoding": encodings,
+                                        "GC Ratio": gc_ratio[ best ],
+                                        "GC Dev (abs)": gc_dev[ best ]
+                                      }
+                                    )
+
+        codons = self.codon_index[ positions, choice ] + 64 * numpy.arange( len( best ) )[ :, None ]
+        codon_ratios = numpy.bincount( codons.ravel(), minlength = 64 * len( best ) ).reshape( len( best ), 64 ) / length
+        aa_ratios    = numpy.array( [ peptide.count( aa ) for aa in AMINO_ACIDS ] ) / length
+
+        ratios = numpy.hstack( [ nucleotides[ best ] / ( 3 * length ),
+                                 numpy.tile( aa_ratios, ( len( best ), 1 ) ),
+                                 codon_ratios
+                               ]
+                             )
+        return seq_frame, pandas.DataFrame( ratios, columns = RATIO_COLUMNS )
+
+def read_encodable_input( filename, sampler ):
+    """
+       Reads name,sequence lines, skipping the same lines main.cpp skips
+    """
+    peptides = list()
+    with open( filename, 'r' ) as open_file:
+        for lineno, line in enumerate( open_file ):
+            line = line.rstrip( '\n' )
+            name, _, peptide = line.partition( ',' )
+            if AMBIGUOUS_CODES.intersection( peptide ):
+                print( "Notice: Skipping oligo with ambiguous code, B,Z U, O or J,  %s." % peptide )
+            elif not name or not peptide or any( aa not in sampler.aa_index for aa in peptide ):
+                print( "Warning: Line %d: %s is invalid and will be skipped." % ( lineno + 1, line ) )
+            else:
+                peptides.append( ( name, peptide ) )
+    return peptides
+
+# Set in each worker by init_sampler
+_sampler = None
+
+def init_sampler( sampler ):
+    global _sampler
+    _sampler = sampler
+
+def sample_peptide( arg ):
+    ( name, peptide ), seed = arg
+    return _sampler.sample( name, peptide, numpy.random.default_rng( seed ) )
+
+def start_codon_sampler( args ):
+    """
+       Creates the CodonSampler for args and, when args.cores > 1, the pool
+       of processes that samples with it. Call this before any other thread
+       is started, as a process forked while other threads hold locks can
+       deadlock.
+
+       Returns:
+        ( sampler, pool ), where pool is None for a single core
+    """
+    sampler = CodonSampler( args.probability_file, args.trials, args.subsample, args.gc_target )
+    if args.cores > 1:
+        return sampler, mp.Pool( args.cores, initializer = init_sampler, initargs = ( sampler, ) )
+
+    init_sampler( sampler )
+    return sampler, None
+
+def sample_chunks( args, chunk_size, sampling = None ):
+    """
+       Samples encodings for every peptide in args.input with CodonSampler,
+       using args.cores processes. sampling is the ( sampler, pool ) returned
+       by start_codon_sampler, which is called here if it is not given. The
+       pool is terminated once sampling ends.
+
+       Yields:
+        ( seq_dataframe, ratio_dataframe ) holding chunk_size rows, as read_chunks does
+    """
+    sampler, pool = sampling if sampling else start_codon_sampler( args )
+    peptides = read_encodable_input( args.input, sampler )
+    seeds    = numpy.random.SeedSequence( args.seed ).spawn( len( peptides ) )
+    per_chunk = max( 1, chunk_size // sampler.subsample )
+
+    if pool:
+        results = pool.imap( sample_peptide, zip( peptides, seeds ) )
+    else:
+        results = map( sample_peptide, zip( peptides, seeds ) )
+
+    try:
+        batch = list()
+        for result in results:
+            batch.append( result )
+            if len( batch ) == per_chunk:
+                yield ( pandas.concat( [ seqs for seqs, _ in batch ], ignore_index = True ),
+                        pandas.concat( [ ratios for _, ratios in batch ], ignore_index = True )
+                      )
+                batch = list()
+        if batch:
+            yield ( pandas.concat( [ seqs for seqs, _ in batch ], ignore_index = True ),
+                    pandas.concat( [ ratios for _, ratios in batch ], ignore_index = True )
+                  )
+    finally:
+        if pool:
+            pool.terminate()
 
 def add_adapters( data, adapter ):
     prefix, suffix = adapter.split( '|' )
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+import argparse
+import io
+import os
+import sys
+import threading
+import types
+import unittest
+
+sys.path.insert( 0, os.path.dirname( os.path.abspath( __file__ ) ) )
+
+# h2o is only needed for scoring, so it need not be installed to run the pipeline tests
+try:
+    import h2o
+except ImportError:
+    sys.modules[ 'h2o' ] = types.ModuleType( 'h2o' )
+
+import oligo_encoding
+
+class SamplerFailureTest( unittest.TestCase ):
+    def setUp( self ):
+        self.sampler_command = oligo_encoding.sampler_command
+
+    def tearDown( self ):
+        oligo_encoding.sampler_command = self.sampler_command
+
+    def run_with_sampler( self, command ):
+        oligo_encoding.sampler_command = lambda args, seq_file, ratio_file: command
+        args = argparse.Namespace( input = 'peptides.fasta', sampler = 'main', sequences = None, ratio_file = None,
+                                   queue_size = 2
+                                 )
+        errors = list()
+
+        def target():
+            try:
+                oligo_encoding.run_pipeline( args, None, io.StringIO(), 10, None )
+            except Exception as error:
+                errors.append( error )
+
+        thread = threading.Thread( target = target, daemon = True )
+        thread.start()
+        thread.join( 30 )
+        self.assertFalse( thread.is_alive(), "run_pipeline hung after the sampler exited" )
+        return errors
+
+    def test_sampler_exits_at_once( self ):
+        errors = self.run_with_sampler( "exit 3" )
+        self.assertEqual( len( errors ), 1 )
+        self.assertIsInstance( errors[ 0 ], RuntimeError )
+        self.assertIn( "status 3", str( errors[ 0 ] ) )
+
+    def test_sampler_writes_nothing( self ):
+        errors = self.run_with_sampler( "true" )
+        self.assertEqual( errors, [] )
+
+if __name__ == '__main__':
+    unittest.main()
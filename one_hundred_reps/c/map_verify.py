@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import argparse
-import protein_oligo_library as oligo
+import math
+import multiprocessing as mp
+import random
 
 def main():
     arg_parser = argparse.ArgumentParser( description = "Verify a map that has been created by the one_hundred_reps script, checks "
@@ -11,13 +13,30 @@ def main():
     arg_parser.add_argument( '-m', '--map_file', help = "Map file produced by one_hundred_reps containing "
                                                         "sequence to collapsed sequences mapping"
                            )
+    arg_parser.add_argument( '-n', '--num_procs', default = 1, type = int,
+                             help = "Number of processes to use for checking collapsed sequences"
+                           )
+    arg_parser.add_argument( '-e', '--sample_error', type = float,
+                             help = "(Optional) Only check a random sample of the collapsed sequences. The sample is "
+                                    "large enough that, if no errors are found, the true proportion of incorrectly "
+                                    "collapsed sequences is below this value with the confidence given by --confidence"
+                           )
+    arg_parser.add_argument( '-c', '--confidence', default = 0.95, type = float,
+                             help = "Confidence level used with --sample_error"
+                           )
+    arg_parser.add_argument( '-s', '--seed', type = int, help = "Seed for the random sample taken with --sample_error" )
 
     args = arg_parser.parse_args()
 
-    original_seq_dict    = fasta_to_dict( args.uncollapsed_input )
+    if args.sample_error is not None and not 0 < args.sample_error < 1:
+        arg_parser.error( "--sample_error must be between 0 and 1, exclusive" )
+    if not 0 < args.confidence < 1:
+        arg_parser.error( "--confidence must be between 0 and 1, exclusive" )
+
+    original_index       = FastaIndex( args.uncollapsed_input )
     collapsed_names_dict = parse_map( args.map_file )
 
-    original_len   = len( original_seq_dict.keys() )
+    original_len   = len( original_index )
     collapsed_len  = len( collapsed_names_dict.keys() )
 
     print( "Original number of sequences:  %d." %  original_len )
@@ -25,23 +44,115 @@ def main():
 
     print( "Number of sequences who were collapsed (expected): %d." % ( original_len - collapsed_len ) )
     print( "Number of sequences who were collapsed (actual):   %d." % sum( [ len( item ) for item in collapsed_names_dict.values() ] ) )
-    
-           
 
-    for collapsed_under, collapsed in collapsed_names_dict.items():
-        for current in collapsed:
-            if original_seq_dict[ current ] not in original_seq_dict[ collapsed_under ]:
-                print( original_seq_dict[ current ], original_seq_dict[ collapsed_under ] )
+    pairs = [ ( collapsed_under, current ) for collapsed_under, collapsed in collapsed_names_dict.items()
+                                           for current in collapsed
+            ]
 
+    if args.sample_error:
+        sample_size = min( get_sample_size( args.sample_error, args.confidence ), len( pairs ) )
+        if sample_size < len( pairs ):
+            pairs = random.Random( args.seed ).sample( pairs, sample_size )
+            print( "Checking a random sample of %d collapsed sequences." % sample_size )
 
+    failed = verify_pairs( original_index, pairs, args.num_procs )
+    for current_seq, under_seq in failed:
+        print( current_seq, under_seq )
 
-def fasta_to_dict( filename ):
-    names, sequences = oligo.read_fasta_lists( filename )
-    out_dict = {}
+    if args.sample_error and not failed:
+        print( "No errors found. The proportion of incorrectly collapsed sequences is below %g with %g%% confidence."
+               % ( args.sample_error, args.confidence * 100 )
+             )
 
-    for index, name in enumerate( names ):
-        out_dict[ name ] = sequences[ index ]
-    return out_dict
+
+class FastaIndex:
+    """
+       Byte offsets of every record in a FASTA file, so sequences can be
+       read by name without loading the whole file
+    """
+    def __init__( self, filename ):
+        self.filename = filename
+        self.offsets  = {}
+        self.handle   = None
+
+        name = None
+        start = 0
+        position = 0
+        with open( filename, 'rb' ) as open_file:
+            for line in open_file:
+                if line.startswith( b'>' ):
+                    if name is not None:
+                        self.offsets[ name ] = ( start, position )
+                    name  = line[ 1: ].strip().decode()
+                    start = position + len( line )
+                position += len( line )
+        if name is not None:
+            self.offsets[ name ] = ( start, position )
+
+    def __len__( self ):
+        return len( self.offsets )
+
+    def __getitem__( self, name ):
+        if self.handle is None:
+            self.handle = open( self.filename, 'rb' )
+
+        start, end = self.offsets[ name ]
+        self.handle.seek( start )
+        return b''.join( self.handle.read( end - start ).split() ).decode()
+
+    def close( self ):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def __getstate__( self ):
+        state = self.__dict__.copy()
+        state[ 'handle' ] = None
+        return state
+
+# Set in the parent before the pool is forked, so workers read it without pickling
+_shared_index = None
+
+def check_pairs( pairs, index = None ):
+    """
+       Returns the ( collapsed sequence, representative sequence ) for every
+       pair in which the collapsed sequence is not contained in its representative
+    """
+    if index is None:
+        index = _shared_index
+
+    failed = list()
+    for collapsed_under, current in pairs:
+        current_seq = index[ current ]
+        under_seq   = index[ collapsed_under ]
+        if current_seq not in under_seq:
+            failed.append( ( current_seq, under_seq ) )
+    return failed
+
+def verify_pairs( index, pairs, num_procs = 1 ):
+    global _shared_index
+
+    if num_procs <= 1 or len( pairs ) < num_procs:
+        return check_pairs( pairs, index )
+
+    # each worker opens its own handle, rather than sharing the parent's file position
+    index.close()
+    _shared_index = index
+    chunk = -( -len( pairs ) // num_procs )
+    chunks = [ pairs[ start:start + chunk ] for start in range( 0, len( pairs ), chunk ) ]
+
+    with mp.get_context( 'fork' ).Pool( num_procs ) as pool:
+        results = pool.map( check_pairs, chunks )
+
+    _shared_index = None
+    return [ item for result in results for item in result ]
+
+def get_sample_size( max_error, confidence ):
+    """
+       Number of pairs that must all pass for the error rate to be below
+       max_error with the given confidence
+    """
+    return int( math.ceil( math.log( 1 - confidence ) / math.log( 1 - max_error ) ) )
 
 def parse_map( map_filename ):
     out_dict = {}
@@ -54,7 +165,7 @@ def parse_map( map_filename ):
             for name in names[1::]:
                 out_dict[ new_key ].append( name.replace( '>', '' ) )
     return out_dict
-                
+
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 import argparse                        # For parsing command-line arguments
+import bisect
+import multiprocessing as mp           # For checking length bands in parallel
+import os
+import shutil
+import tempfile
 #import protein_oligo_library as oligo  # for operations on Fasta files
 from collections import defaultdict
 
@@ -38,6 +43,30 @@ def read_fasta_lists( file_to_read ):
 
     return names, sequences
 
+def iter_fasta( file_to_read ):
+    """
+       Reads a fasta file one record at a time
+
+       Yields:
+        ( name, sequence ) for each record in the file
+    """
+    name = None
+    current_sequence = list()
+
+    with open( file_to_read, 'r' ) as file_in:
+        for line in file_in:
+            line = line.strip()
+            if line and line[ 0 ] == '>':
+                if name is not None:
+                    yield name, ''.join( current_sequence )
+                name = line[ 1: ]
+                current_sequence = list()
+            else:
+                current_sequence.append( line )
+
+    if name is not None:
+        yield name, ''.join( current_sequence )
+
 def get_unique_seqs( names_list, sequence_list ):
     sequence_dict = {}
     out_names, out_seqs = list(), list()
@@ -60,18 +89,57 @@ def main():
     arg_parser.add_argument( '-m', '--map_file', help = "(Optional) Name of map to write the map of what "
                                                    "sequences were collapsed under what sequences."
                            )
+    arg_parser.add_argument( '-e', '--engine', default = 'linear', choices = sorted( ENGINES.keys() ),
+                             help = "Method used to check whether a sequence is contained in one of the representatives "
+                                    "chosen so far. 'linear' tests each representative in turn, 'automaton' indexes "
+                                    "the representatives in a generalized suffix automaton so each check costs about "
+                                    "the length of the sequence, at the expense of memory. 'kmer' only tests the "
+                                    "representatives that contain the rarest of the sequence's kmers. Output is "
+                                    "identical for every engine."
+                           )
+    arg_parser.add_argument( '-k', '--seed_size', default = 5, type = int,
+                             help = "Size of the kmers used to find candidate representatives with '--engine kmer'."
+                           )
+    arg_parser.add_argument( '-j', '--jobs', default = 1, type = int,
+                             help = "Number of processes to use. Sequences are processed in bands of similar length, "
+                                    "and the sequences within a band are checked in parallel against the longer "
+                                    "representatives. Output is identical to a single process run."
+                           )
+    arg_parser.add_argument( '-s', '--spill_dir',
+                             help = "(Optional) Directory for temporary files. If provided, the input is first split "
+                                    "into files of sequences with similar length, which are processed longest first, "
+                                    "so only the representatives are held in memory. Representatives and the map are "
+                                    "written as they are found. Use this for inputs larger than the available memory."
+                           )
+    arg_parser.add_argument( '-b', '--bucket_width', default = 10, type = int,
+                             help = "Range of sequence lengths stored in each temporary file with '--spill_dir'."
+                           )
 
     args = arg_parser.parse_args()
 
     # TODO validate args
+    if args.bucket_width < 1:
+        arg_parser.error( "--bucket_width must be at least 1" )
+
+    if args.spill_dir:
+        engine  = create_engine( args )
+        indexer = SortIndexer( len )
 
+        num_input, num_reps = get_one_hundred_reps_external( args.fasta, indexer, engine, args.representatives,
+                                                             args.map_file, args.spill_dir, args.jobs,
+                                                             args.bucket_width
+                                                           )
+        print( "Number of seqs in original: %d" % num_input )
+        print( "Number of seqs in output:   %d" % num_reps )
+        return
 
     input_parser = FastaParser( args.fasta )
     input_seqs   = input_parser.parse()
     indexer      = SortIndexer( len )
+    engine       = create_engine( args )
 
     # get the 100% reps for each sequence
-    final_seqs, map_out = get_one_hundred_reps( input_seqs, indexer, args.map_file != None )
+    final_seqs, map_out = get_one_hundred_reps( input_seqs, indexer, args.map_file != None, engine, args.jobs )
 
     print( "Number of seqs in original: %d" % len( input_seqs ) )
     print( "Number of seqs in output:   %d" % len( final_seqs ) )
@@ -138,42 +206,470 @@ class SortIndexer( Indexer ):
     def index( self, in_list, reverse = False ):
         return( sorted( in_list, key = self.sort_key, reverse = reverse ) )
 
-def get_one_hundred_reps( seq_list, indexer, do_map = False ):
+class ContainmentEngine:
+    """
+       Keeps the representatives chosen so far, in the order they were added,
+       and finds the first one that contains a given sequence.
+    """
+    def __init__( self ):
+        self.reps = list()
+
+    def add( self, seq ):
+        self.reps.append( seq )
+
+    def find( self, seq, start = 0 ):
+        """
+           Returns the index in self.reps of the first representative
+           containing seq, or None if no representative contains it.
+           Only representatives from index start on are searched, so
+           start should only be given when none before it contain seq.
+        """
+        pass
+
+class LinearContainment( ContainmentEngine ):
+    def find( self, seq, start = 0 ):
+        for index in range( start, len( self.reps ) ):
+            if seq.seq in self.reps[ index ].seq:
+                return index
+        return None
+
+class SuffixAutomatonContainment( ContainmentEngine ):
+    """
+       Generalized suffix automaton over every representative. Each state
+       records the index of the first representative in which its substrings
+       occur, so a containment query is a single walk over the query's characters.
+    """
+    def __init__( self ):
+        super().__init__()
+        self.next   = [ dict() ]
+        self.link   = [ -1 ]
+        self.length = [ 0 ]
+        self.first  = [ -1 ]
+
+    def _new_state( self, length, link = -1, next_states = None, first = -1 ):
+        self.next.append( next_states if next_states is not None else dict() )
+        self.link.append( link )
+        self.length.append( length )
+        self.first.append( first )
+        return len( self.length ) - 1
+
+    def _clone( self, prev, state, char ):
+        clone = self._new_state( self.length[ prev ] + 1, self.link[ state ],
+                                 dict( self.next[ state ] ), self.first[ state ]
+                               )
+        while prev != -1 and self.next[ prev ].get( char ) == state:
+            self.next[ prev ][ char ] = clone
+            prev = self.link[ prev ]
+        self.link[ state ] = clone
+        return clone
+
+    def _extend( self, last, char ):
+        if char in self.next[ last ]:
+            state = self.next[ last ][ char ]
+            if self.length[ last ] + 1 == self.length[ state ]:
+                return state
+            return self._clone( last, state, char )
+
+        current = self._new_state( self.length[ last ] + 1 )
+        prev = last
+        while prev != -1 and char not in self.next[ prev ]:
+            self.next[ prev ][ char ] = current
+            prev = self.link[ prev ]
+
+        if prev == -1:
+            self.link[ current ] = 0
+        else:
+            state = self.next[ prev ][ char ]
+            if self.length[ prev ] + 1 == self.length[ state ]:
+                self.link[ current ] = state
+            else:
+                self.link[ current ] = self._clone( prev, state, char )
+        return current
+
+    def add( self, seq ):
+        index = len( self.reps )
+        super().add( seq )
+
+        last = 0
+        for char in seq.seq:
+            last = self._extend( last, char )
+
+            # Mark every suffix of this prefix that has not been seen in an earlier rep.
+            # Once a marked state is reached, all of its suffix links are marked too.
+            state = last
+            while state != -1 and self.first[ state ] == -1:
+                self.first[ state ] = index
+                state = self.link[ state ]
+
+    def find( self, seq, start = 0 ):
+        # a single walk checks every representative, so start is not needed
+        state = 0
+        for char in seq.seq:
+            state = self.next[ state ].get( char )
+            if state is None:
+                return None
+        if self.first[ state ] == -1:
+            return None
+        return self.first[ state ]
+
+class KmerSeedContainment( ContainmentEngine ):
+    """
+       Inverted index from kmer to the representatives containing it. A query
+       can only be contained in representatives holding every one of its kmers,
+       so only those holding its rarest kmer are tested.
+    """
+    def __init__( self, seed_size = 5 ):
+        super().__init__()
+        self.seed_size = seed_size
+        self.index     = defaultdict( list )
+
+    def _kmers( self, seq ):
+        return { seq[ start:start + self.seed_size ] for start in range( len( seq ) - self.seed_size + 1 ) }
+
+    def add( self, seq ):
+        # representatives are added in order, so each kmer's list stays sorted
+        index = len( self.reps )
+        super().add( seq )
+
+        for kmer in self._kmers( seq.seq ):
+            self.index[ kmer ].append( index )
+
+    def find( self, seq, start = 0 ):
+        candidates = None
+
+        if len( seq ) < self.seed_size:
+            candidates = range( start, len( self.reps ) )
+        else:
+            for kmer in self._kmers( seq.seq ):
+                holders = self.index.get( kmer )
+                if holders is None:
+                    return None
+                if candidates is None or len( holders ) < len( candidates ):
+                    candidates = holders
+            candidates = candidates[ bisect.bisect_left( candidates, start ): ]
+
+        for index in candidates:
+            if seq.seq in self.reps[ index ].seq:
+                return index
+        return None
+
+ENGINES = { 'linear': LinearContainment,
+            'automaton': SuffixAutomatonContainment,
+            'kmer': KmerSeedContainment
+          }
+
+def create_engine( args ):
+    if args.engine == 'kmer':
+        return KmerSeedContainment( args.seed_size )
+    return ENGINES[ args.engine ]()
+
+# Minimum number of sequences in a band before it is split across processes
+MIN_BAND_SIZE = 2000
+
+def _band_worker( engine, conn ):
+    # Receives ( new representatives, sequences ) until None is sent, and
+    # replies with the result of find for each sequence
+    for new_reps, part in iter( conn.recv, None ):
+        try:
+            for rep in new_reps:
+                engine.add( rep )
+            conn.send( [ engine.find( item ) for item in part ] )
+        except Exception as error:
+            conn.send( error )
+
+class BandWorkers:
+    """
+       Processes forked once, each holding its own copy of the engine. The
+       representatives added since the last band are sent to every worker
+       along with its share of the next band, so the workers are reused
+       for every band of the run.
+    """
+    def __init__( self, engine, jobs ):
+        self.engine = engine
+        self.synced = len( engine.reps )
+        self.conns  = list()
+        self.procs  = list()
+
+        context = mp.get_context( 'fork' )
+        for _ in range( jobs ):
+            parent_conn, child_conn = context.Pipe()
+            proc = context.Process( target = _band_worker, args = ( engine, child_conn ), daemon = True )
+            proc.start()
+            child_conn.close()
+            self.conns.append( parent_conn )
+            self.procs.append( proc )
+
+    def __len__( self ):
+        return len( self.conns )
+
+    def find( self, band ):
+        new_reps = self.engine.reps[ self.synced: ]
+        self.synced = len( self.engine.reps )
+
+        # every worker gets the new representatives, even if its share of the band is empty
+        chunk = -( -len( band ) // len( self.conns ) )
+        for number, conn in enumerate( self.conns ):
+            conn.send( ( new_reps, band[ number * chunk:( number + 1 ) * chunk ] ) )
+
+        found_list = list()
+        for conn in self.conns:
+            result = conn.recv()
+            if isinstance( result, Exception ):
+                raise result
+            found_list += result
+        return found_list
+
+    def close( self ):
+        for conn in self.conns:
+            conn.send( None )
+            conn.close()
+        for proc in self.procs:
+            proc.join()
+
+def get_length_bands( indexed_seqs, indexer, jobs ):
+    """
+       Splits the indexed sequences into consecutive bands. A band is never
+       split between two sequences with the same sort key, and holds at least
+       MIN_BAND_SIZE sequences when jobs > 1. Each sequence is its own band
+       when jobs is 1.
+    """
+    if jobs <= 1:
+        for item in indexed_seqs:
+            yield [ item ]
+        return
+
+    band = list()
+    for item in indexed_seqs:
+        if len( band ) >= MIN_BAND_SIZE and indexer.sort_key( item ) != indexer.sort_key( band[ -1 ] ):
+            yield band
+            band = list()
+        band.append( item )
+    if band:
+        yield band
+
+def find_in_band( engine, band, workers = None ):
+    """
+       Checks every sequence in band against the representatives currently
+       in engine, splitting the band across workers if given
+    """
+    if workers is None or len( band ) < len( workers ):
+        return [ engine.find( item ) for item in band ]
+    return workers.find( band )
+
+def assign_representatives( indexed_seqs, indexer, engine, jobs = 1, workers = None ):
+    """
+       Runs the containment checks over indexed_seqs, adding every sequence
+       not contained in an earlier representative to engine. When jobs > 1
+       and no BandWorkers are given, workers are started for this call.
+
+       Yields:
+        ( sequence, index ) in processing order, where index is the position in
+        engine.reps of the representative containing the sequence, or None if
+        the sequence became a new representative
+    """
+    own_workers = workers is None and jobs > 1
+    if own_workers:
+        workers = BandWorkers( engine, jobs )
+
+    try:
+        for band in get_length_bands( indexed_seqs, indexer, jobs ):
+            # every sequence in the band is first checked against the longer representatives
+            found_list = find_in_band( engine, band, workers )
+            band_start = len( engine.reps )
+
+            for current_seq, found in zip( band, found_list ):
+                if found is None and len( engine.reps ) > band_start:
+                    # only representatives chosen earlier in this band can still contain it
+                    found = engine.find( current_seq, band_start )
+
+                if found is None:
+                    engine.add( current_seq )
+                yield current_seq, found
+    finally:
+        if own_workers:
+            workers.close()
+
+def get_one_hundred_reps( seq_list, indexer, do_map = False, engine = None, jobs = 1 ):
     out_map      = None
     out_dict = {}
-    added = False
 
     if do_map:
         out_map = out_dict
+    if engine is None:
+        engine = LinearContainment()
 
-    unique_seqs = get_unique_sequences( seq_list )
+    # exact duplicates are collapsed up front, so only unique sequences reach the containment checks
+    unique_seqs, duplicates = get_unique_sequences( seq_list )
     
     indexed_seqs = indexer.index( unique_seqs, reverse = True )
     out_seqs     = set()
 
-    for current_seq in indexed_seqs:
-        for seq, value in out_dict.items():
-            if current_seq.seq in seq.seq:
-                out_dict[ seq ].append( current_seq )
-                added = True
-                break
-        if not added:
+    for current_seq, found in assign_representatives( indexed_seqs, indexer, engine, jobs ):
+        if found is not None:
+            out_dict[ engine.reps[ found ] ].append( current_seq )
+        else:
             out_dict[ current_seq ] = list()
             out_seqs.add( current_seq )
-        added = False
+
+    if duplicates:
+        restore_duplicates( out_dict, duplicates, seq_list, indexer )
             
     return list( out_seqs ), out_map
 
 def get_unique_sequences( seq_list ):
-    seq_fact = SequenceFactory()
+    """
+       Collapses identical sequences, keeping the first occurrence of each
+
+       Returns:
+        unique_seqs- the first occurrence of each distinct sequence, in input order
+        duplicates- dict mapping each kept Sequence to the later Sequences identical to it
+    """
+    first_seen = {}
+    duplicates = defaultdict( list )
+
+    for item in seq_list:
+        kept = first_seen.setdefault( item.seq, item )
+        if kept is not item:
+            duplicates[ kept ].append( item )
+
+    return list( first_seen.values() ), duplicates
+
+def restore_duplicates( out_dict, duplicates, seq_list, indexer ):
+    """
+       Adds the duplicates removed by get_unique_sequences back into out_dict.
+       Each duplicate goes under the same representative as the sequence it
+       is identical to, and every list is put back in the order the sequences
+       would have been processed without the prepass.
+    """
+    position = { id( item ): index for index, item in enumerate( seq_list ) }
 
-    names_list = [ item.name for item in seq_list ]
-    seq_list   = [ item.seq for item in seq_list ]
+    for rep, collapsed in out_dict.items():
+        members = list( duplicates.get( rep, list() ) )
+        for item in collapsed:
+            members.append( item )
+            members += duplicates.get( item, list() )
 
-#    new_names, new_seqs = get_unique_seqs( names_list, seq_list )
+        if len( members ) != len( collapsed ):
+            members.sort( key = lambda item: position[ id( item ) ] )
+            out_dict[ rep ] = indexer.index( members, reverse = True )
 
-#    return seq_fact.create_seq_list( new_names, new_seqs )
-    return seq_fact.create_seq_list( names_list, seq_list )
+# Number of representatives whose map entries share one temporary file
+MAP_PARTITION_SIZE = 100000
+
+class SpillWriter:
+    """
+       Buffers text for many temporary files, keyed by integer, and appends
+       it to disk once buffer_size characters are held, so at most one file
+       is open at a time
+    """
+    def __init__( self, directory, prefix, buffer_size = 1 << 26 ):
+        self.directory   = directory
+        self.prefix      = prefix
+        self.buffer_size = buffer_size
+        self.buffers     = defaultdict( list )
+        self.buffered    = 0
+        self.keys        = set()
+
+    def path( self, key ):
+        return os.path.join( self.directory, "%s_%d.txt" % ( self.prefix, key ) )
+
+    def write( self, key, text ):
+        self.buffers[ key ].append( text )
+        self.keys.add( key )
+        self.buffered += len( text )
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush( self ):
+        for key, texts in self.buffers.items():
+            with open( self.path( key ), 'a' ) as open_file:
+                open_file.write( ''.join( texts ) )
+        self.buffers  = defaultdict( list )
+        self.buffered = 0
+
+def get_one_hundred_reps_external( fasta, indexer, engine, seq_file, map_file, spill_dir, jobs = 1, bucket_width = 10 ):
+    """
+       Out-of-core version of get_one_hundred_reps. The input is streamed into
+       temporary files of sequences within bucket_width of each other in length,
+       and the files are processed longest first. Only the representatives in
+       engine are kept for the whole run. Representatives are written to seq_file
+       as they are chosen, and map entries are spilled to disk and grouped by
+       representative at the end, so the output matches get_one_hundred_reps.
+
+       Returns:
+        num_input- the number of sequences in fasta
+        num_reps- the number of representatives written
+    """
+    work_dir    = tempfile.mkdtemp( dir = spill_dir )
+    seq_factory = SequenceFactory()
+    num_input   = 0
+    workers     = None
+    rep_out     = None
+
+    try:
+        buckets = SpillWriter( work_dir, 'bucket' )
+        for name, sequence in iter_fasta( fasta ):
+            buckets.write( len( sequence ) // bucket_width, ">%s\n%s\n" % ( name, sequence ) )
+            num_input += 1
+        buckets.flush()
+
+        map_spill = SpillWriter( work_dir, 'map' )
+        if seq_file:
+            rep_out = open( seq_file, 'w' )
+        if jobs > 1:
+            workers = BandWorkers( engine, jobs )
+
+        for key in sorted( buckets.keys, reverse = True ):
+            names, sequences = read_fasta_lists( buckets.path( key ) )
+            os.remove( buckets.path( key ) )
+
+            bucket_seqs = seq_factory.create_seq_list( names, sequences )
+            unique_seqs, duplicates = get_unique_sequences( bucket_seqs )
+            indexed_seqs = indexer.index( unique_seqs, reverse = True )
+
+            # duplicates share a length, so they are always in the same bucket as their first occurrence
+            rep_index = {}
+            for current_seq, found in assign_representatives( indexed_seqs, indexer, engine, jobs, workers ):
+                if found is None:
+                    found = len( engine.reps ) - 1
+                    if rep_out:
+                        rep_out.write( str( current_seq ) )
+                rep_index[ id( current_seq ) ] = found
+
+            if map_file:
+                kept_of = { id( dup ): kept for kept, dups in duplicates.items() for dup in dups }
+
+                # entries are spilled in the order the in-memory version would list them
+                for item in indexer.index( bucket_seqs, reverse = True ):
+                    found = rep_index[ id( kept_of.get( id( item ), item ) ) ]
+                    if engine.reps[ found ] is not item:
+                        map_spill.write( found // MAP_PARTITION_SIZE, "%d\t%s\n" % ( found, item.name ) )
+
+        if map_file:
+            map_spill.flush()
+            write_map_external( map_file, engine.reps, map_spill )
+    finally:
+        if rep_out:
+            rep_out.close()
+        if workers is not None:
+            workers.close()
+        shutil.rmtree( work_dir )
+
+    return num_input, len( engine.reps )
+
+def write_map_external( map_file, reps, map_spill ):
+    with open( map_file, 'w' ) as open_file:
+        for partition in range( -( -len( reps ) // MAP_PARTITION_SIZE ) ):
+            collapsed = defaultdict( list )
+            if partition in map_spill.keys:
+                with open( map_spill.path( partition ), 'r' ) as spill_file:
+                    for line in spill_file:
+                        index, name = line.rstrip( '\n' ).split( '\t', 1 )
+                        collapsed[ int( index ) ].append( name )
+
+            start = partition * MAP_PARTITION_SIZE
+            for index in range( start, min( start + MAP_PARTITION_SIZE, len( reps ) ) ):
+                open_file.write( "%s\t%s\n" % ( reps[ index ].name, ','.join( collapsed[ index ] ) ) )
 
 def write_outputs( seq_file, seq_list, map_file, out_map ):
     if seq_file: